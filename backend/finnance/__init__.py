@@ -1,73 +1,97 @@
 # Import flask and template operators
-import json
+import os
 import traceback
+import weakref
 from http import HTTPStatus
 
-from flask import Blueprint, Flask, current_app, request
+from flask import Flask, current_app
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
-from jsonschema import Draft202012Validator, ValidationError
 
 from finnance.errors.errors import APIError
 
-# Define the WSGI application object
-app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+# Define the database object which is imported
+# by modules and controllers, bound to an app by create_app
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
 
-# Configurations
-app.config.from_object('finnance.config')
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
+def create_app(config='finnance.config') -> Flask:
+    # Define the WSGI application object
+    app = Flask(__name__)
+    CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-# Define the database object which is imported
-# by modules and controllers
-db = SQLAlchemy(app)
-from . import models
-
-with app.app_context():
-    db.create_all()
-
-
-from finnance.accounts import accounts
-from finnance.agents import agents
-# Import a module / component using its blueprint handler variable
-from finnance.auth import auth
-from finnance.categories import categories
-from finnance.currencies import currencies
-from finnance.transactions import transactions
-from finnance.transfers import transfers
-from finnance.nivo import nivo
-from finnance.templates import templates
-from finnance.flows import flows
-from finnance.records import records
-
-# Register blueprints
-app.register_blueprint(auth)
-app.register_blueprint(accounts)
-app.register_blueprint(categories)
-app.register_blueprint(currencies)
-app.register_blueprint(agents)
-app.register_blueprint(transactions)
-app.register_blueprint(transfers)
-app.register_blueprint(nivo)
-app.register_blueprint(templates)
-app.register_blueprint(flows)
-app.register_blueprint(records)
+    # Configurations
+    app.config.from_object(config)
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+
+    # Import a module / component using its blueprint handler variable,
+    # only once an app is built, so that importing finnance stays cheap
+    from finnance.accounts import accounts
+    from finnance.agents import agents
+    from finnance.auth import auth
+    from finnance.categories import categories
+    from finnance.currencies import currencies
+    from finnance.export import export
+    from finnance.flows import flows
+    from finnance.nivo import nivo
+    from finnance.records import records
+    from finnance.templates import templates
+    from finnance.transactions import transactions
+    from finnance.transfers import transfers
+
+    # Register blueprints
+    app.register_blueprint(auth)
+    app.register_blueprint(accounts)
+    app.register_blueprint(categories)
+    app.register_blueprint(currencies)
+    app.register_blueprint(agents)
+    app.register_blueprint(transactions)
+    app.register_blueprint(transfers)
+    app.register_blueprint(nivo)
+    app.register_blueprint(templates)
+    app.register_blueprint(flows)
+    app.register_blueprint(records)
+    app.register_blueprint(export)
+
+    # the schema is managed by `flask migrate`, nothing here touches the
+    # database
+    from finnance import migrations, search
+    app.cli.add_command(migrations.migrate)
+    app.cli.add_command(search.rebuild_command)
+
+    app.register_error_handler(APIError, handle_apierror)
+    app.register_error_handler(404, handle_404)
+    app.register_error_handler(Exception, handle_exception)
+
+    apps.add(app)
+    return app
+
+# apps built in this process, without keeping them alive
+apps = weakref.WeakSet()
+
+def dispose_engines():
+    # pooled connections must not be shared with the forked workers
+    for app in list(apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=dispose_engines)
 
 # ERROR HANDLING
 ################
 
-@app.errorhandler(APIError)
 def handle_apierror(err: APIError):
     return err.msg, err.status.value
 
-@app.errorhandler(404)
 def handle_404(e):
     return handle_apierror(APIError(HTTPStatus.NOT_FOUND))
 
-@app.errorhandler(Exception)
 def handle_exception(err: Exception):
     app = current_app
     app.logger.error(f"Unknown Exception: {str(err)}")
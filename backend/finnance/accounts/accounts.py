@@ -2,8 +2,12 @@ import re
 from datetime import datetime
 from http import HTTPStatus
 
+import sqlalchemy
+from finnance.cache import etag
 from finnance.errors import APIError, validate
-from finnance.models import Account, Currency, JSONModel
+from finnance.models import (Account, AccountBalance, AccountTransfer, Currency, JSONModel,
+                             MonthlyTotal, Transaction)
+from finnance.ordering import move, next_order, reorder
 from finnance.params import parseSearchParams
 from flask import Blueprint, jsonify, request
 from flask_login import current_user, login_required
@@ -14,15 +18,16 @@ accounts = Blueprint('accounts', __name__, url_prefix='/api/accounts')
 
 @accounts.route("")
 @login_required
+@etag('account', 'currency', 'trans', 'account_transfer')
 def all_accounts():
-    accs = Account.query.filter_by(
+    accs = Account.query.options(*Account.json_options()).filter_by(
         user_id=current_user.id).order_by(Account.order.asc()).all()
     return JSONModel.obj_to_api([acc.json(deep=True) for acc in accs])
 
 @accounts.route("/<int:account_id>")
 @login_required
 def account(account_id):
-    acc = Account.query.filter_by(
+    acc = Account.query.options(*Account.json_options()).filter_by(
         user_id=current_user.id, id=account_id).first()
     if acc is None:
         raise APIError(HTTPStatus.NOT_FOUND)
@@ -86,8 +91,11 @@ def edit_account(account_id: int, **data):
         if Currency.query.filter_by(user_id=current_user.id, id=data['currency_id']).first() is None:
             raise APIError(HTTPStatus.BAD_REQUEST, "invalid currency_id")
         account.currency_id = data['currency_id']
+        monthly_totals = [t for trans in account.transactions for t in trans.monthly_totals()]
         for trans in account.transactions:
             trans.currency_id = data['currency_id']
+        MonthlyTotal.book(monthly_totals, sign=-1)
+        MonthlyTotal.book([t for trans in account.transactions for t in trans.monthly_totals()])
         
     db.session.commit()
     return '', HTTPStatus.CREATED
@@ -109,29 +117,26 @@ def edit_account(account_id: int, **data):
     }
 })
 def edit_account_orders(orders: list[int], ids: list[int]):
-    if len(orders) != len(ids):
-        raise APIError(HTTPStatus.BAD_REQUEST, "orders and ids must have same length")
-
-    n_changed = 0
-
-
-    for acc_id, order in zip(ids, orders):
-        account: Account = Account.query.filter_by(user_id=current_user.id, id=acc_id).first()
-        if account is None:
-            raise APIError(HTTPStatus.BAD_REQUEST, "non-existent account id")
-        if order < 0:
-            raise APIError(HTTPStatus.BAD_REQUEST, "order must be non-negative")
-        if account.order == order:
-            continue
-        n_changed += 1
-        account.order = -n_changed
-
-    for acc_id, order in zip(ids, orders):
-        account: Account = Account.query.filter_by(user_id=current_user.id, id=acc_id).first()
-        if account.order == order:
-            continue
-        account.order = order
+    reorder(Account, [Account.user_id == current_user.id], ids, orders)
+    db.session.commit()
+    return '', HTTPStatus.CREATED
 
+@accounts.route("/orders/move", methods=["PUT"])
+@login_required
+@validate({
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "before": {"type": "integer"},
+        "after": {"type": "integer"}
+    },
+    "required": ["id"]
+})
+def move_account(id: int, before: int = None, after: int = None):
+    account = Account.query.filter_by(user_id=current_user.id, id=id).first()
+    if account is None:
+        raise APIError(HTTPStatus.BAD_REQUEST, "non-existent account id")
+    move(account, [Account.user_id == current_user.id], before=before, after=after)
     db.session.commit()
     return '', HTTPStatus.CREATED
 
@@ -156,10 +161,13 @@ def add_acc(desc: str, starting_saldo: int, date_created: str, currency_id: int,
         raise APIError(HTTPStatus.BAD_REQUEST, "invalid currency_id")
     if not re.match('^#[a-fA-F0-9]{6}$', color):
         raise APIError(HTTPStatus.BAD_REQUEST, "color: invalid color hex-string")
-    order = max([acc.order for acc in current_user.accounts] + [0]) + 1
+    order = next_order(Account, Account.user_id == current_user.id)
     account = Account(desc=desc, starting_saldo=starting_saldo, order=order, color=color,
         date_created=date_created, currency_id=currency_id, user_id=current_user.id)
     db.session.add(account)
+    db.session.flush()
+    # nothing booked on it yet
+    db.session.add(AccountBalance(account_id=account.id, delta=0))
     db.session.commit()
     return '', HTTPStatus.CREATED
 
@@ -183,16 +191,9 @@ def delete_account(account_id: int):
     if acc is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     
-    for trans in acc.transactions:
-        for flow in trans.flows:
-            db.session.delete(flow)
-        for rec in trans.records:
-            db.session.delete(rec)
-        db.session.delete(trans)
-    for tf in acc.in_transfers:
-        db.session.delete(tf)
-    for tf in acc.out_transfers:
-        db.session.delete(tf)
+    Transaction.delete_where(Transaction.account_id == acc.id)
+    AccountTransfer.delete_where(sqlalchemy.or_(AccountTransfer.src_id == acc.id, AccountTransfer.dst_id == acc.id))
+    AccountBalance.drop(acc.id)
     db.session.delete(acc)
     db.session.commit()
 
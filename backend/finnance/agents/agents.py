@@ -1,38 +1,186 @@
+import heapq
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
 from http import HTTPStatus
 
+import click
 import sqlalchemy
+from finnance.cache import etag
 from finnance.errors import APIError
-from finnance.models import Agent, Flow, JSONModel, Transaction
-from flask import Blueprint
+from finnance.models import Agent, DataVersion, JSONModel
+from finnance.params import parseSearchParams
+from flask import Blueprint, request
 from flask_login import current_user, login_required
 
 from finnance import db
 
 agents = Blueprint('agents', __name__, url_prefix='/api/agents')
 
+
+class PrefixIndex:
+    # per user agent descs sorted case-insensitively, so that a prefix is a
+    # contiguous slice, along with their uses for the ranking. an entry
+    # remembers the agent data version it was built at and is rebuilt once
+    # agents were created, edited or deleted, uses booked by this worker
+    # process are applied in place, those of other workers show up with
+    # the next rebuild
+    def __init__(self, max_users: int = 0):
+        self.max_users = max_users
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, user_id: int):
+        version = DataVersion.get(user_id, 'agent')
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry['version'] == version:
+                self.entries.move_to_end(user_id)
+                return entry
+        rows = sorted(
+            (desc.lower(), desc, uses, id) for id, desc, uses in
+            db.session.query(Agent.id, Agent.desc, Agent.uses).filter_by(user_id=user_id)
+        )
+        entry = dict(
+            version=version,
+            keys=[key for key, _, _, _ in rows],
+            descs=[desc for _, desc, _, _ in rows],
+            uses=[uses for _, _, uses, _ in rows],
+            positions={id: i for i, (_, _, _, id) in enumerate(rows)},
+        )
+        with self.lock:
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_users:
+                self.entries.popitem(last=False)
+        return entry
+
+    def book(self, user_id: int, deltas: dict[int, int]):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return
+            for agent_id, delta in deltas.items():
+                if agent_id in entry['positions']:
+                    entry['uses'][entry['positions'][agent_id]] += delta
+
+    def drop(self, user_id: int):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def complete(self, user_id: int, prefix: str, limit: int) -> list[str]:
+        entry = self.load(user_id)
+        keys, descs, uses = entry['keys'], entry['descs'], entry['uses']
+        prefix = prefix.lower()
+        start = bisect_left(keys, prefix)
+        # keys starting with the prefix sort before prefix + the largest char
+        end = bisect_left(keys, prefix + chr(0x10ffff), lo=start)
+        with self.lock:
+            best = heapq.nsmallest(limit, range(start, end), key=lambda i: (-uses[i], descs[i]))
+        return [descs[i] for i in best]
+
+
+index = PrefixIndex()
+
+# sized by the app the blueprint gets registered on
+@agents.record_once
+def configure(state):
+    index.max_users = state.app.config['AGENT_INDEX_USERS']
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def book_uses(session):
+    # uses booked by the committed transaction, see Agent.book
+    for user_id, deltas in session.info.pop('agent_uses', {}).items():
+        if deltas is None:
+            index.drop(user_id)
+        else:
+            index.book(user_id, deltas)
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def forget_uses(session):
+    session.info.pop('agent_uses', None)
+
 @agents.route("")
 @login_required
+@etag('agent', 'trans', 'flow')
 def all_agents():
-    agents = Agent.query.filter_by(user_id=current_user.id).join(Transaction, isouter=True).join(
-        Flow, sqlalchemy.and_(Agent.id == Flow.agent_id, 
-        Transaction.id == Flow.trans_id), isouter=True).group_by(
-            Agent.id).order_by(Agent.uses.desc(), Agent.desc)
-    return JSONModel.obj_to_api([agent.desc for agent in agents])
+    kwargs = parseSearchParams(request.args.to_dict(), dict(limit=int, offset=int))
+    if kwargs.get('limit', 0) < 0 or kwargs.get('offset', 0) < 0:
+        raise APIError(HTTPStatus.BAD_REQUEST, 'invalid limit or offset')
+    # served from ix_agent_uses, no transactions involved
+    agents = db.session.query(Agent.desc).filter_by(user_id=current_user.id).order_by(
+        Agent.uses.desc(), Agent.desc).offset(kwargs.get('offset')).limit(kwargs.get('limit'))
+    return JSONModel.obj_to_api([desc for desc, in agents])
+
+@agents.route("/complete")
+@login_required
+def complete_agents():
+    kwargs = parseSearchParams(request.args.to_dict(), dict(q=str, limit=int))
+    limit = kwargs.get('limit', 10)
+    if limit < 0:
+        raise APIError(HTTPStatus.BAD_REQUEST, 'invalid limit')
+    return JSONModel.obj_to_api(index.complete(current_user.id, kwargs.get('q', ''), limit))
 
 @agents.route("/<int:agent_id>")
 @login_required
 def agent(agent_id):
-    agent = Agent.query.filter_by(user_id=current_user.id, id=agent_id).order_by(Agent.desc).first()
+    agent = Agent.query.options(*Agent.json_options()).filter_by(user_id=current_user.id, id=agent_id).order_by(Agent.desc).first()
     if agent is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     return agent.api()
 
-def create_agent_ifnx(agent_desc):
-    if agent_desc is None:
-        return None
-    agent = Agent.query.filter_by(desc=agent_desc, user_id=current_user.id).first()
-    if not agent:
-        agent = Agent(desc=agent_desc, user_id=current_user.id)
-        db.session.add(agent)
-        db.session.commit()
-    return agent
\ No newline at end of file
+# descs per lookup, sqlite allows at most 500 selects in a union
+FIND_CHUNK = 400
+
+def find_agents(descs: set[str], lock=False) -> dict[str, Agent]:
+    descs = sorted(descs)
+    found = {}
+    for start in range(0, len(descs), FIND_CHUNK):
+        # the requested descs joined against the agents, so that the database
+        # decides which row matches which desc with its own collation, mariadb
+        # ignores case, accents and trailing spaces
+        requested = sqlalchemy.union_all(*[
+            sqlalchemy.select(sqlalchemy.literal(desc, Agent.desc.type).label('desc'))
+            for desc in descs[start:start + FIND_CHUNK]
+        ]).subquery()
+        query = db.session.query(requested.c.desc, Agent).join(
+            Agent, Agent.desc == requested.c.desc).filter(Agent.user_id == current_user.id)
+        if lock:
+            # a locking read sees rows committed after our snapshot on mariadb
+            query = query.with_for_update(read=True)
+        for desc, agent in query:
+            if desc not in found or agent.desc == desc:
+                found[desc] = agent
+    return found
+
+def resolve_agents(agent_descs) -> dict[str, Agent]:
+    # agents by desc, the missing ones are created in the caller's transaction
+    descs = {desc for desc in agent_descs if desc is not None}
+    agents = find_agents(descs)
+    for attempt in range(3):
+        missing = sorted(descs - agents.keys())
+        if len(missing) == 0:
+            return agents
+        # all at once first, after a conflict one savepoint per desc, so
+        # that the conflicting one doesn't roll back the others
+        batches = [missing] if attempt == 0 else [[desc] for desc in missing]
+        for batch in batches:
+            try:
+                with db.session.begin_nested():
+                    db.session.add_all([Agent(desc=desc, user_id=current_user.id) for desc in batch])
+            except sqlalchemy.exc.IntegrityError:
+                # created by a concurrent request in the meantime, or equal
+                # to another desc of the batch under the collation
+                pass
+        agents = find_agents(descs, lock=True)
+    missing = descs - agents.keys()
+    if len(missing) > 0:
+        raise APIError(HTTPStatus.CONFLICT, f"agents could not be created: {', '.join(sorted(missing))}")
+    return agents
+
+@agents.cli.command('uses')
+def rebuild_uses():
+    """Recount how often each agent is used by transactions and flows."""
+    db.session.execute(sqlalchemy.update(Agent).values(uses=Agent.count_uses()))
+    db.session.commit()
+    click.echo('agent uses rebuilt')
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+from http import HTTPStatus
+
+from flask import current_app, request
+from flask_login import current_user
+
+from finnance.models import DataVersion
+
+
+class ResponseCache:
+    # lru of response bodies bounded by their total size, entries are
+    # keyed per user and request and remember the data version they were
+    # built at, local to the worker process
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version: int):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version: int, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (version, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+                entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes
+            )
+
+
+def cached(cache: ResponseCache):
+    def decorator(foo):
+        @wraps(foo)
+        def wrapper(**kwargs):
+            key = (current_user.id, request.endpoint, tuple(sorted(request.args.items(multi=True))))
+            version = DataVersion.get(current_user.id)
+            data = cache.get(key, version)
+            if data is not None:
+                return current_app.response_class(data, mimetype=current_app.json.mimetype)
+            response = foo(**kwargs)
+            if response.status_code == 200:
+                cache.put(key, version, response.get_data())
+            return response
+        return wrapper
+    return decorator
+
+
+def etag(*kinds):
+    # tables the response is built from, a matching If-None-Match is
+    # answered before the view runs
+    def decorator(foo):
+        @wraps(foo)
+        def wrapper(**kwargs):
+            tag = f'{current_user.id}-{DataVersion.get(current_user.id, *kinds)}'
+            if request.if_none_match.contains(tag):
+                response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+            else:
+                response = foo(**kwargs)
+            if response.status_code in [HTTPStatus.OK, HTTPStatus.NOT_MODIFIED]:
+                response.set_etag(tag)
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
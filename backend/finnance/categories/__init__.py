@@ -1 +1 @@
-from .categories import categories
\ No newline at end of file
+from .categories import CategoryTree, categories
\ No newline at end of file
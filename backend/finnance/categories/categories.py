@@ -1,10 +1,17 @@
 
 import re
+from collections import defaultdict
+from datetime import datetime
 from http import HTTPStatus
 
+import click
+import sqlalchemy
+from finnance.cache import etag
 from finnance.errors import APIError, validate
-from finnance.models import Category, JSONModel
-from flask import Blueprint, jsonify
+from finnance.models import Category, CategoryClosure, JSONModel, Record, Transaction
+from finnance.ordering import move, next_order, reorder
+from finnance.params import parseSearchParams
+from flask import Blueprint, g, jsonify, request
 from flask_login import current_user, login_required
 
 from finnance import db
@@ -14,68 +21,141 @@ categories = Blueprint('categories', __name__, url_prefix='/api/categories')
 @categories.route("/<int:category_id>")
 @login_required
 def category(category_id):
-    cat = Category.query.filter_by(
+    cat = Category.query.options(*Category.json_options()).filter_by(
         user_id=current_user.id, id=category_id).first()
     if cat is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     return cat.api()
 
-def with_parent(parent_id: int | None, is_expense: bool):
-    return Category.query.filter_by(
-        user_id=current_user.id, parent_id=parent_id, is_expense=is_expense
-    ).order_by(
-        Category.is_expense, Category.order
-    ).all()
+class CategoryTree:
+    # all of a user's categories from a single query, for the lifetime of
+    # the request
+    def __init__(self, cats: list[Category]):
+        self.by_id = {cat.id: cat for cat in cats}
+        self.children_of = defaultdict(list)
+        for cat in cats:
+            self.children_of[cat.parent_id].append(cat)
 
-def hierarchy(category: Category, json=False):
+    @staticmethod
+    def load():
+        if 'category_tree' not in g:
+            g.category_tree = CategoryTree(Category.query.filter_by(
+                user_id=current_user.id
+            ).order_by(
+                Category.is_expense, Category.order
+            ).all())
+        return g.category_tree
+
+    def get(self, category_id: int) -> Category | None:
+        return self.by_id.get(category_id)
+
+    def parent(self, category: Category) -> Category | None:
+        return self.by_id.get(category.parent_id)
+
+    def children(self, category: Category) -> list[Category]:
+        return self.children_of[category.id]
+
+    def roots(self, is_expense: bool) -> list[Category]:
+        return [cat for cat in self.children_of[None] if cat.is_expense == is_expense]
+
+    def ancestors(self, category: Category) -> list[Category]:
+        # closest first
+        out = []
+        while (category := self.parent(category)) is not None:
+            out.append(category)
+        return out
+
+    def descendants(self, category: Category) -> list[Category]:
+        # depth first, in order
+        return [
+            cat for child in self.children(category)
+            for cat in [child, *self.descendants(child)]
+        ]
+
+def hierarchy(tree: CategoryTree, category: Category, json=False):
     return {
         'category': category.json(deep=False) if json else category,
         'children': [
-            hierarchy(cat, json=json)
-            for cat in with_parent(category.id, category.is_expense)
+            hierarchy(tree, cat, json=json)
+            for cat in tree.children(category)
         ]
     }
 
-def flatten(category, children):
+def flatten(tree: CategoryTree, category, children):
     return [
         dict(id=category.id, desc=category.desc, usable=category.usable,
-             parent_desc=category.desc if category.parent_id is None else category.parent.desc),
+             parent_desc=category.desc if category.parent_id is None else tree.parent(category).desc),
         *[
-            cat for child in children for cat in flatten(**child)
+            cat for child in children for cat in flatten(tree, **child)
         ]
     ]
 
 def group_descs(is_expense: bool):
+    tree = CategoryTree.load()
     return [dict(
         group=cat.desc,
-        items = flatten(**hierarchy(cat))
-    ) for cat in with_parent(None, is_expense)]
+        items = flatten(tree, **hierarchy(tree, cat))
+    ) for cat in tree.roots(is_expense)]
             
 
 @categories.route("/expenses")
 @login_required
+@etag('category')
 def expenses_descs():
     return JSONModel.obj_to_api(group_descs(True))
 
 @categories.route("/incomes")
 @login_required
+@etag('category')
 def incomes_descs():
     return JSONModel.obj_to_api(group_descs(False))
     
 @categories.route("/hierarchy/expenses")
 @login_required
+@etag('category')
 def expenses_hierarchy():
+    tree = CategoryTree.load()
     return JSONModel.obj_to_api([
-        hierarchy(cat, json=True) for cat in with_parent(None, True)
+        hierarchy(tree, cat, json=True) for cat in tree.roots(True)
     ])
 
 @categories.route("/hierarchy/incomes")
 @login_required
+@etag('category')
 def incomes_hierarchy():
+    tree = CategoryTree.load()
     return JSONModel.obj_to_api([
-        hierarchy(cat, json=True) for cat in with_parent(None, False)
+        hierarchy(tree, cat, json=True) for cat in tree.roots(False)
     ])
 
+@categories.route("/<int:category_id>/total")
+@login_required
+def subtree_total(category_id):
+    # records of the category and all of its descendants
+    cat = Category.query.filter_by(user_id=current_user.id, id=category_id).first()
+    if cat is None:
+        raise APIError(HTTPStatus.NOT_FOUND)
+    kwargs = parseSearchParams(request.args.to_dict(), dict(
+        currency_id=int, start=datetime, end=datetime
+    ))
+    if 'currency_id' not in kwargs:
+        raise APIError(HTTPStatus.BAD_REQUEST, 'currency_id must be in search parameters')
+
+    query = db.session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(Record.amount), 0)).select_from(
+        CategoryClosure
+    ).join(Record, Record.category_id == CategoryClosure.descendant_id).join(
+        Transaction, Record.trans_id == Transaction.id
+    ).filter(
+        CategoryClosure.ancestor_id == cat.id,
+        Transaction.currency_id == kwargs['currency_id']
+    )
+    if 'start' in kwargs:
+        query = query.filter(Transaction.date_issued >= kwargs['start'])
+    if 'end' in kwargs:
+        query = query.filter(Transaction.date_issued < kwargs['end'])
+
+    return jsonify(category_id=cat.id, currency_id=kwargs['currency_id'], total=int(query.scalar()))
+
 @categories.route("/add", methods=["POST"])
 @login_required
 @validate({
@@ -101,15 +181,15 @@ def add_category(desc: str, is_expense: bool, color: str, usable: bool, parent_i
     if not re.match('^#[a-fA-F0-9]{6}$', color):
         raise APIError(HTTPStatus.BAD_REQUEST, "color: invalid color hex-string")
     
-    order = max([
-        cat.order for cat in current_user.categories if cat.is_expense == is_expense
-        ] + [0]) + 1
+    order = next_order(Category, Category.user_id == current_user.id, Category.is_expense == is_expense)
     
     category = Category(desc=desc, user_id=current_user.id, usable=usable,
                         color=color, parent_id=parent_id, is_expense=is_expense,
                         order=order)
         
     db.session.add(category)
+    db.session.flush()
+    CategoryClosure.attach(category.id, parent_id)
     db.session.commit()
     return '', HTTPStatus.CREATED
 
@@ -144,13 +224,17 @@ def edit_category(category_id: int, **data):
         changed = changed or category.usable != data['usable']
         category.usable = data['usable']
 
-    if 'parent_id' in data:
-        changed = changed or category.parent_id != data['parent_id']
+    if 'parent_id' in data and category.parent_id != data['parent_id']:
+        changed = True
         if data['parent_id'] == category.id: 
             raise APIError(HTTPStatus.BAD_REQUEST, "parent_id must not be its own id")
-        if data['parent_id'] is not None and Category.query.filter_by(user_id=current_user.id, id=data['parent_id']) is None:
+        if data['parent_id'] is not None and Category.query.filter_by(
+                user_id=current_user.id, id=data['parent_id'], is_expense=category.is_expense).first() is None:
             raise APIError(HTTPStatus.BAD_REQUEST, "invalid parent_id")
+        if data['parent_id'] is not None and CategoryClosure.is_below(data['parent_id'], category.id):
+            raise APIError(HTTPStatus.BAD_REQUEST, "parent_id must not be a descendant")
         category.parent_id = data['parent_id']
+        CategoryClosure.move(category.id, category.parent_id)
 
     if not changed:
         raise APIError(HTTPStatus.BAD_REQUEST, "edit request has no changes")
@@ -175,30 +259,48 @@ def edit_category(category_id: int, **data):
     }
 })
 def edit_category_orders(orders: list[int], ids: list[int]):
-    if len(orders) != len(ids):
-        raise APIError(HTTPStatus.BAD_REQUEST, "orders and ids must have same length")
-
-    n_changed = 0
-
-    for cat_id, order in zip(ids, orders):
-        category: Category = Category.query.filter_by(user_id=current_user.id, id=cat_id).first()
-        if category is None:
-            raise APIError(HTTPStatus.BAD_REQUEST, "non-existent category id")
-        if order < 0:
-            raise APIError(HTTPStatus.BAD_REQUEST, "order must be non-negative")
-        if category.order == order:
-            continue
-        n_changed += 1
-        category.order = -n_changed
-
-    if n_changed == 0:
+    if reorder(Category, [Category.user_id == current_user.id], ids, orders) == 0:
         raise APIError(HTTPStatus.BAD_REQUEST, "edit request has no changes")
+    db.session.commit()
+    return '', HTTPStatus.CREATED
 
-    for cat_id, order in zip(ids, orders):
-        category: Category = Category.query.filter_by(user_id=current_user.id, id=cat_id).first()
-        if category.order == order:
-            continue
-        category.order = order
-
+@categories.route("/orders/move", methods=["PUT"])
+@login_required
+@validate({
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "before": {"type": "integer"},
+        "after": {"type": "integer"}
+    },
+    "required": ["id"]
+})
+def move_category(id: int, before: int = None, after: int = None):
+    category = Category.query.filter_by(user_id=current_user.id, id=id).first()
+    if category is None:
+        raise APIError(HTTPStatus.BAD_REQUEST, "non-existent category id")
+    # incomes and expenses are ordered separately
+    move(category, [Category.user_id == current_user.id, Category.is_expense == category.is_expense],
+         before=before, after=after)
     db.session.commit()
     return '', HTTPStatus.CREATED
+
+def rebuild_closure():
+    db.session.execute(sqlalchemy.delete(CategoryClosure))
+    parents = dict(db.session.query(Category.id, Category.parent_id))
+    rows = []
+    for category_id in parents:
+        ancestor_id, depth = category_id, 0
+        # bounded, in case older edits left a cycle behind
+        while ancestor_id is not None and depth < len(parents):
+            rows.append(dict(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+    if len(rows) > 0:
+        db.session.execute(sqlalchemy.insert(CategoryClosure), rows)
+    db.session.commit()
+
+@categories.cli.command('closure')
+def rebuild_closure_command():
+    """Rebuild the category closure table from the parent ids."""
+    rebuild_closure()
+    click.echo('category closure rebuilt')
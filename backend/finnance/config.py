@@ -38,6 +38,12 @@ if not get_debug_flag():
 else:
     SECRET_KEY = 'debug_secret_crazy_secure'
 
+# upper bound for the cached nivo responses of one worker process
+NIVO_CACHE_BYTES = 32 * 1024 * 1024
+
+# users whose agent autocomplete index one worker process keeps in memory
+AGENT_INDEX_USERS = 256
+
 # FLASK-LOGIN
 
 REMEMBER_COOKIE_DURATION = dt.timedelta(days=28)
\ No newline at end of file
@@ -1,8 +1,11 @@
 
 from http import HTTPStatus
 
+import sqlalchemy
+from finnance.cache import etag
 from finnance.errors import APIError, validate
-from finnance.models import Currency, JSONModel
+from finnance.models import (Account, AccountBalance, AccountTransfer, Currency, JSONModel,
+                             Transaction)
 from flask import Blueprint, jsonify
 from flask_login import current_user, login_required
 
@@ -12,6 +15,7 @@ currencies = Blueprint('currencies', __name__, url_prefix='/api/currencies')
 
 @currencies.route("")
 @login_required
+@etag('currency')
 def all_currencies():
     currencies = Currency.query.filter_by(user_id=current_user.id)
     return JSONModel.obj_to_api([cur.json(deep=False) for cur in currencies])
@@ -19,7 +23,8 @@ def all_currencies():
 @currencies.route("/<int:currency_id>")
 @login_required
 def currency(currency_id):
-    currency = Currency.query.filter_by(user_id=current_user.id, id=currency_id).first()
+    currency = Currency.query.options(*Currency.json_options()).filter_by(
+        user_id=current_user.id, id=currency_id).first()
     if currency is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     return currency.api()
@@ -60,18 +65,13 @@ def delete_currency(currency_id: int):
     if curr is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     
-    for trans in curr.transactions:
-        for flow in trans.flows:
-            db.session.delete(flow)
-        for rec in trans.records:
-            db.session.delete(rec)
-        db.session.delete(trans)
+    Transaction.delete_where(Transaction.currency_id == curr.id)
     
+    accounts = sqlalchemy.select(Account.id).where(Account.currency_id == curr.id)
+    AccountTransfer.delete_where(sqlalchemy.or_(
+        AccountTransfer.src_id.in_(accounts), AccountTransfer.dst_id.in_(accounts)))
     for acc in curr.accounts:
-        for tf in acc.in_transfers:
-            db.session.delete(tf)
-        for tf in acc.out_transfers:
-            db.session.delete(tf)
+        AccountBalance.drop(acc.id)
         db.session.delete(acc)
     
     db.session.delete(curr)
@@ -0,0 +1 @@
+from .export import export
\ No newline at end of file
@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from http import HTTPStatus
+
+import sqlalchemy
+from finnance.errors import APIError
+from finnance.models import (Account, AccountTransfer, Agent, Category, Currency, Flow,
+                             JSONModel, Record, Transaction)
+from flask import Blueprint, current_app, request, stream_with_context
+from flask_login import current_user, login_required
+
+from finnance import db
+
+export = Blueprint('export', __name__, url_prefix='/api/export')
+
+# rows fetched and written per round trip, memory stays bounded by it
+CHUNK = 1000
+
+# exported before the transactions, in this order
+TABLES = [
+    ('currency', Currency), ('account', Account), ('category', Category),
+    ('agent', Agent), ('transfer', AccountTransfer)
+]
+
+def columns(model):
+    return [
+        column for column in model.__table__.columns
+        if column.key != 'user_id' and column.key not in model.json_ignore
+    ]
+
+def ledger(user_id: int):
+    # (type, row) pairs of everything the user owns, plain rows instead of
+    # models so that nothing piles up in the session
+    for kind, model in TABLES:
+        query = sqlalchemy.select(*columns(model)).where(
+            model.user_id == user_id).order_by(model.id).execution_options(yield_per=CHUNK)
+        result = db.session.execute(query)
+        keys = list(result.keys())
+        for row in result:
+            yield kind, dict(zip(keys, row))
+
+    # transactions in id chunks, each with the records and flows of the chunk
+    last_id = 0
+    while True:
+        result = db.session.execute(sqlalchemy.select(*columns(Transaction)).where(
+            Transaction.user_id == user_id, Transaction.id > last_id
+        ).order_by(Transaction.id).limit(CHUNK))
+        keys = list(result.keys())
+        chunk = [dict(zip(keys, row)) for row in result]
+        if len(chunk) == 0:
+            break
+        ids = [trans['id'] for trans in chunk]
+        nested = dict(records=defaultdict(list), flows=defaultdict(list))
+        for key, model in [('records', Record), ('flows', Flow)]:
+            result = db.session.execute(sqlalchemy.select(*columns(model)).where(
+                model.trans_id.in_(ids)).order_by(model.id))
+            keys = list(result.keys())
+            for row in result:
+                row = dict(zip(keys, row))
+                nested[key][row['trans_id']].append(row)
+        for trans in chunk:
+            trans.update(records=nested['records'][trans['id']], flows=nested['flows'][trans['id']])
+            yield 'transaction', trans
+        last_id = ids[-1]
+
+def batched(lines):
+    # one write per chunk instead of per line
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == CHUNK:
+            yield ''.join(batch)
+            batch = []
+    if len(batch) > 0:
+        yield ''.join(batch)
+
+def jsonl_lines(rows):
+    for kind, row in rows:
+        yield f"{json.dumps(dict(type=kind, **row), default=JSONModel.default)}\n"
+
+def csv_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return JSONModel.default(value) if value is not None else ''
+
+def csv_lines(rows):
+    # one table, records and flows follow their transaction as rows of
+    # their own, columns a type doesn't have stay empty
+    header = ['type']
+    for model in [model for _, model in TABLES] + [Transaction, Record, Flow]:
+        header += [column.key for column in columns(model) if column.key not in header]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, header)
+
+    def line(row):
+        writer.writerow({key: csv_value(value) for key, value in row.items()})
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(dict(zip(header, header)))
+    for kind, row in rows:
+        if kind != 'transaction':
+            yield line(dict(row, type=kind))
+            continue
+        records, flows = row.pop('records'), row.pop('flows')
+        yield line(dict(row, type=kind))
+        for record in records:
+            yield line(dict(record, type='record'))
+        for flow in flows:
+            yield line(dict(flow, type='flow'))
+
+FORMATS = {
+    'jsonl': (jsonl_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+@export.route("")
+@login_required
+def export_ledger():
+    format = request.args.get('format', 'jsonl')
+    if format not in FORMATS:
+        raise APIError(HTTPStatus.BAD_REQUEST, 'format must be either jsonl or csv')
+    lines, mimetype = FORMATS[format]
+    response = current_app.response_class(
+        stream_with_context(batched(lines(ledger(current_user.id)))), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=finnance.{format}'
+    return response
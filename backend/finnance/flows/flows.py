@@ -1,8 +1,8 @@
 from datetime import datetime
-from math import ceil
 
-from finnance.params import parseSearchParams
-from finnance.models import Flow, Transaction, JSONModel
+from finnance.params import Cursor, paginate, parseSearchParams
+from finnance.search import matches
+from finnance.models import Agent, Flow, Transaction, JSONModel
 from flask import Blueprint, request
 from flask_login import current_user, login_required
 
@@ -12,30 +12,28 @@ flows = Blueprint('flows', __name__, url_prefix='/api/flows')
 @login_required
 def get_flows():
     kwargs = parseSearchParams(request.args.to_dict(), dict(
-        start=datetime, end=datetime, search=str
+        start=datetime, end=datetime, search=str, before=Cursor
     ))
 
-    result = Flow.query.join(Transaction).filter_by(user_id=current_user.id).order_by(Transaction.date_issued.desc())
+    result = Flow.query.options(*Flow.json_options()).join(Transaction).filter_by(user_id=current_user.id)
     if 'start' in kwargs:
         result = result.filter(Transaction.date_issued >= kwargs.get('start'))
     if 'end' in kwargs:
         result = result.filter(Transaction.date_issued < kwargs.get('end'))
-    
-    pagesize = kwargs.get('pagesize')
-    page = kwargs.get('page')
 
-    # search filter
-    result = list(filter(
-        lambda f: 'search' not in kwargs or any(
-            kwargs['search'].lower() in string for string in [
-                f.trans.comment.lower(),
-                f.agent.desc.lower(),
-        ]),
-        result.all()
-    ))
+    # search filter
+    if 'search' in kwargs:
+        result = result.join(Agent, Flow.agent_id == Agent.id).filter(
+            matches(kwargs['search'],
+                ('trans', Flow.trans_id, Transaction.comment),
+                ('agent', Flow.agent_id, Agent.desc)))
+
+    pages, result = paginate(result, Transaction.date_issued, Flow.id,
+                             kwargs.get('pagesize'), kwargs.get('page'), kwargs.get('before'))
     return JSONModel.obj_to_api(dict(
-        pages= ceil(len(result) / pagesize),
+        pages=pages,
+        next=Cursor.of(result[-1].trans.date_issued, result[-1].id) if len(result) else None,
         flows=[
         flow.json(deep=True)
-        for flow in result[pagesize*page:pagesize*(page+1)]
+        for flow in result
     ]))
\ No newline at end of file
@@ -0,0 +1,109 @@
+from datetime import datetime
+
+import click
+import sqlalchemy
+from flask.cli import with_appcontext
+
+from finnance import db
+from finnance.categories.categories import rebuild_closure
+from finnance.models import Account, AccountBalance, AccountTransfer, Agent, Category, Flow, Record, Transaction, TransactionTemplate
+from finnance.nivo.nivo import rebuild_monthly_totals
+from finnance.search import rebuild as rebuild_search_index
+
+
+class SchemaMigration(db.Model):
+    # migrations applied to this database, create_all only ever creates
+    # missing tables, everything else about existing ones happens here
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+
+# (version, name, step) in the order they are applied
+MIGRATIONS = []
+
+def migration(version: int, name: str):
+    def decorator(foo):
+        MIGRATIONS.append((version, name, foo))
+        return foo
+    return decorator
+
+# steps run on fresh databases too, where create_all already did the
+# schema part, so they check before they change anything
+
+def add_column(model, key: str):
+    table = model.__table__
+    if key in [column['name'] for column in sqlalchemy.inspect(db.engine).get_columns(table.name)]:
+        return
+    column = sqlalchemy.schema.CreateColumn(table.c[key]).compile(dialect=db.engine.dialect)
+    db.session.execute(sqlalchemy.text(f'ALTER TABLE {table.name} ADD COLUMN {column}'))
+    db.session.commit()
+
+def create_indexes(*models):
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+@migration(1, 'search index')
+def search_index():
+    rebuild_search_index()
+
+@migration(2, 'monthly totals')
+def monthly_totals():
+    rebuild_monthly_totals()
+
+@migration(3, 'category closure')
+def category_closure():
+    rebuild_closure()
+
+@migration(4, 'agent uses')
+def agent_uses():
+    add_column(Agent, 'uses')
+    create_indexes(Agent)
+    db.session.execute(sqlalchemy.update(Agent).values(uses=Agent.count_uses()))
+    db.session.commit()
+
+@migration(5, 'order indexes')
+def order_indexes():
+    create_indexes(Account, Category, TransactionTemplate)
+
+@migration(6, 'listing and join indexes')
+def listing_indexes():
+    create_indexes(Transaction, Record, Flow, AccountTransfer)
+
+@migration(7, 'account balances')
+def account_balances():
+    # writers only update existing balances, every account needs one
+    AccountBalance.backfill()
+    db.session.commit()
+
+
+def pending():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    applied = {version for version, in db.session.query(SchemaMigration.version)}
+    return [(version, name, step) for version, name, step in sorted(MIGRATIONS) if version not in applied]
+
+def upgrade():
+    db.create_all()
+    for version, name, step in pending():
+        click.echo(f'migration {version}: {name}')
+        step()
+        try:
+            db.session.add(SchemaMigration(version=version, name=name, applied_at=datetime.now()))
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # applied by another `flask migrate` at the same time
+            db.session.rollback()
+
+
+@click.command('migrate')
+@with_appcontext
+@click.option('--list', 'list_only', is_flag=True, help='Only list the pending migrations.')
+def migrate(list_only):
+    """Create missing tables and apply the pending schema migrations."""
+    if list_only:
+        for version, name, _ in pending():
+            click.echo(f'migration {version}: {name}')
+        return
+    upgrade()
+    click.echo('schema up to date')
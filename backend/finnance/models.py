@@ -1,18 +1,22 @@
 import json
+from collections import defaultdict
 from math import ceil
-from flask import current_app
+from flask import current_app, has_request_context
 import sqlalchemy
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.sql.schema import CheckConstraint, UniqueConstraint
-from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import func
 from finnance import db, login_manager
-from flask_login import UserMixin
+from finnance.search import drop_rows, matches
+from flask_login import UserMixin, current_user
 import datetime as dt
 
 
 class JSONModel:
     json_relations = []
     json_ignore = []
+    # relations read by the properties of a shallow json()
+    json_preload = []
 
     @staticmethod
     def default(obj):
@@ -38,27 +42,56 @@ class JSONModel:
         if isinstance(obj, sqlalchemy.orm.collections.InstrumentedList
                       ) or isinstance(obj, list):
             return [item.json(deep=False) for item in obj]
+        if type(obj) is dt.datetime:
+            return obj.isoformat()
         return obj
 
+    @classmethod
+    def compile_json(cls):
+        # what json() walks, worked out once per class instead of per call
+        mapper = sqlalchemy.inspect(cls)
+        cls.json_columns = tuple(
+            attr.key for attr in mapper.column_attrs if attr.key not in cls.json_ignore)
+        # relationships loaded as None show up as null, as they always have
+        cls.json_scalar_relations = tuple(
+            rel.key for rel in mapper.relationships if not rel.uselist and rel.key not in cls.json_ignore)
+        cls.json_properties = tuple(
+            key for key in vars(cls) if isinstance(getattr(cls, key), property))
+        cls.json_type = cls.__name__.lower()
+
+    @classmethod
+    def json_options(cls, deep=True):
+        # loader options fetching everything json(deep) touches up front
+        mapper = sqlalchemy.inspect(cls)
+        options = [
+            sqlalchemy.orm.selectinload(getattr(cls, key))
+            for key in cls.json_preload if not (deep and key in cls.json_relations)
+        ]
+        if deep:
+            for key in cls.json_relations:
+                rel = mapper.relationships[key]
+                load = sqlalchemy.orm.selectinload if rel.uselist else sqlalchemy.orm.joinedload
+                options.append(load(getattr(cls, key)).options(
+                    *rel.mapper.class_.json_options(deep=False)))
+        return options
+
     def json(self, deep: bool):
-        d = {
-            key: self.jsonValue(value)
-            for key, value in self.__dict__.items()
-            if not (key.startswith('_') or key in self.json_ignore
-                    or isinstance(value, db.Model) or isinstance(value, sqlalchemy.orm.collections.InstrumentedList))
-        }
-        # properties
-        d.update({
-            key: self.jsonValue(getattr(self, key))
-            for key in vars(type(self))
-            if isinstance(getattr(type(self), key), property)
-        })
-        d["type"] = type(self).__name__.lower()
+        state = self.__dict__
+        d = {}
+        # only what is loaded, like the instance dict
+        for key in self.json_columns:
+            if key in state:
+                value = state[key]
+                d[key] = value.isoformat() if type(value) is dt.datetime else value
+        for key in self.json_scalar_relations:
+            if key in state and state[key] is None:
+                d[key] = None
+        for key in self.json_properties:
+            d[key] = self.jsonValue(getattr(self, key))
+        d["type"] = self.json_type
         if deep:
-            d.update({
-                key: self.jsonValue(getattr(self, key))
-                for key in self.json_relations
-            })
+            for key in self.json_relations:
+                d[key] = self.jsonValue(getattr(self, key))
         return d
 
 
@@ -94,13 +127,18 @@ class Account(db.Model, JSONModel):
 
     currency = db.relationship("Currency", backref="accounts")
     user = db.relationship("User", backref="accounts")
+    # only to load the balances along with the accounts, see saldo
+    balance = db.relationship("AccountBalance", uselist=False, viewonly=True)
 
     __table_args__ = (
         UniqueConstraint('desc', 'user_id'),
-        UniqueConstraint('order', 'user_id')
+        UniqueConstraint('order', 'user_id'),
+        db.Index('ix_account_order', 'user_id', 'order'),
     )
 
     json_relations = ["currency"]
+    json_ignore = ["balance"]
+    json_preload = ["balance"]
 
     def changes(self, num=None):
         saldos = [self.starting_saldo]
@@ -120,62 +158,101 @@ class Account(db.Model, JSONModel):
 
         return changes[::-1] if num is None else changes[-num:][::-1], saldos[::-1]
 
-    def jsonify_changes(self, pagesize, page, start=None, end=None, search: str = None):
-        saldo = self.starting_saldo
-        changes = sorted(
-            self.transactions + self.out_transfers + self.in_transfers,
-            key=lambda ch: ch.date_issued
-        )
-        filtered = []
-
-        for i, change in enumerate(changes):
-            if type(change) is AccountTransfer:
-                exp = change.src_id == self.id
-                amount = change.src_amount if exp else change.dst_amount
-            else:
-                exp = change.is_expense
-                amount = change.amount
-
-            saldo = saldo + (amount if not exp else -amount)
-
-            if (start is not None and start > change.date_issued):
-                continue
-            if (end is not None and change.date_issued >= end):
-                continue
-
-            if type(change) is Transaction:
-                desc = change.agent.desc
-            elif change.src_id == self.id:
-                desc = change.dst.desc
-            else:
-                desc = change.src.desc
-
-            if (search is not None):
-                inComment = search.lower() in change.comment.lower()
-                inAgent = search.lower() in desc.lower()
-                if not inComment and not inAgent:
-                    continue
+    def changes_query(self):
+        # kind: 0 transaction, 1 outgoing transfer, 2 incoming transfer
+        Source, Destination = sqlalchemy.orm.aliased(Account), sqlalchemy.orm.aliased(Account)
+        return sqlalchemy.union_all(
+            sqlalchemy.select(
+                sqlalchemy.literal(0).label('kind'), Transaction.id, Transaction.date_issued,
+                Transaction.comment, Transaction.agent_id.label('target_id'),
+                Agent.desc.label('target'),
+                sqlalchemy.case(
+                    (Transaction.is_expense, -Transaction.amount), else_=Transaction.amount
+                ).label('delta'),
+            ).join(Agent, Transaction.agent_id == Agent.id
+            ).where(Transaction.account_id == self.id),
+            sqlalchemy.select(
+                sqlalchemy.literal(1).label('kind'), AccountTransfer.id, AccountTransfer.date_issued,
+                AccountTransfer.comment, AccountTransfer.dst_id.label('target_id'),
+                Destination.desc.label('target'),
+                (-AccountTransfer.src_amount).label('delta'),
+            ).join(Destination, AccountTransfer.dst_id == Destination.id
+            ).where(AccountTransfer.src_id == self.id),
+            sqlalchemy.select(
+                sqlalchemy.literal(2).label('kind'), AccountTransfer.id, AccountTransfer.date_issued,
+                AccountTransfer.comment, AccountTransfer.src_id.label('target_id'),
+                Source.desc.label('target'),
+                AccountTransfer.dst_amount.label('delta'),
+            ).join(Source, AccountTransfer.src_id == Source.id
+            ).where(AccountTransfer.dst_id == self.id),
+        ).subquery()
 
-            filtered.append((saldo, desc, change))
+    def jsonify_changes(self, pagesize, page, start=None, end=None, search: str = None):
+        changes = self.changes_query()
+        running = sqlalchemy.select(
+            changes,
+            (self.starting_saldo + func.sum(changes.c.delta).over(
+                order_by=(changes.c.date_issued, changes.c.kind, changes.c.id),
+                rows=(None, 0)
+            )).label('saldo')
+        ).subquery()
+
+        filtered = sqlalchemy.select(running.c.kind, running.c.id, running.c.target, running.c.saldo)
+        if start is not None:
+            filtered = filtered.where(running.c.date_issued >= start)
+        if end is not None:
+            filtered = filtered.where(running.c.date_issued < end)
+        if search is not None:
+            filtered = filtered.where(sqlalchemy.or_(
+                sqlalchemy.and_(running.c.kind == 0, matches(search,
+                    ('trans', running.c.id, running.c.comment),
+                    ('agent', running.c.target_id, running.c.target))),
+                sqlalchemy.and_(running.c.kind != 0, matches(search,
+                    ('account_transfer', running.c.id, running.c.comment),
+                    ('account', running.c.target_id, running.c.target))),
+            ))
+
+        rows = db.session.execute(
+            filtered.add_columns(func.count().over().label('total')).order_by(
+                running.c.date_issued.desc(), running.c.kind.desc(), running.c.id.desc()
+            ).limit(pagesize).offset(pagesize*page)
+        ).all()
+        if len(rows) > 0:
+            total = rows[0].total
+        else:
+            total = db.session.execute(
+                sqlalchemy.select(func.count()).select_from(filtered.subquery())).scalar()
+
+        # only materialize the changes on this page
+        trans_ids = [row.id for row in rows if row.kind == 0]
+        transfer_ids = [row.id for row in rows if row.kind != 0]
+        objects = {
+            **{(0, t.id): t for t in Transaction.query.filter(Transaction.id.in_(trans_ids))},
+            **{(1, t.id): t for t in AccountTransfer.query.filter(AccountTransfer.id.in_(transfer_ids))},
+        }
 
         out = [{
             "type": "account_change",
             "acc_id": self.id,
-            "saldo": saldo,
-            "target": desc,
-            "data": change.json(deep=False)
+            "saldo": row.saldo,
+            "target": row.target,
+            "data": objects[(min(row.kind, 1), row.id)].json(deep=False)
         }
-            for (saldo, desc, change) in filtered[::-1][pagesize*page:pagesize*(page+1)]
+            for row in rows
         ]
 
         return JSONModel.obj_to_api({
-            "pages": ceil(len(filtered) / pagesize),
+            "pages": ceil(total / pagesize),
             "changes": out
         })
 
     @property
     def saldo(self):
-        return self.changes(num=1)[1][0]
+        balance = db.session.get(AccountBalance, self.id)
+        if balance is None:
+            # only until `flask migrate` has created the missing balances
+            return self.starting_saldo + AccountBalance.compute(self.id)
+        return self.starting_saldo + balance.delta
 
     def starting(self):
         return self.currency.format(self.starting_saldo)
@@ -200,9 +277,61 @@ class Transaction(db.Model, JSONModel):
     agent = db.relationship("Agent", backref="transactions")
     currency = db.relationship("Currency", backref="transactions")
 
+    # listings filter by one of these and sort by date_issued
+    __table_args__ = (
+        db.Index('ix_trans_user_date', 'user_id', 'date_issued'),
+        db.Index('ix_trans_account_date', 'account_id', 'date_issued'),
+        db.Index('ix_trans_currency_date', 'currency_id', 'date_issued'),
+    )
+
     json_relations = ["account",
                       "agent", "currency", "records", "flows"]
 
+    def saldo_changes(self):
+        return [(self.account_id, -self.amount if self.is_expense else self.amount)]
+
+    def agent_uses(self):
+        return [(self.agent_id, 1)] + [(flow.agent_id, 1) for flow in self.flows]
+
+    def monthly_totals(self):
+        month = self.date_issued.strftime('%Y-%m')
+        return [
+            ((self.user_id, self.currency_id, month, rec.category_id, self.agent_id, self.is_expense), rec.amount)
+            for rec in self.records
+        ]
+
+    @staticmethod
+    def delete_where(*criteria):
+        # set-based delete of the user's matching transactions with their
+        # records and flows, nothing is loaded into the session, so what the
+        # flush hooks would keep up to date is done here as well
+        where = [Transaction.user_id == current_user.id, *criteria]
+        ids = sqlalchemy.select(Transaction.id).where(*where)
+
+        AccountBalance.book(db.session.execute(sqlalchemy.select(
+            Transaction.account_id,
+            func.sum(sqlalchemy.case((Transaction.is_expense, -Transaction.amount), else_=Transaction.amount))
+        ).where(*where).group_by(Transaction.account_id)).all(), sign=-1)
+        month = MonthlyTotal.month_of(Transaction.date_issued).label('month')
+        MonthlyTotal.unbook(current_user.id, sqlalchemy.select(
+            Transaction.user_id, Transaction.currency_id, month, Record.category_id,
+            Transaction.agent_id, Transaction.is_expense,
+            func.sum(Record.amount).label('amount'), func.count().label('count')
+        ).join(Transaction, Record.trans_id == Transaction.id).where(*where).group_by(
+            Transaction.user_id, Transaction.currency_id, month, Record.category_id,
+            Transaction.agent_id, Transaction.is_expense))
+        Agent.unbook(sqlalchemy.union_all(
+            sqlalchemy.select(Transaction.agent_id).where(*where),
+            sqlalchemy.select(Flow.agent_id).join(Transaction, Flow.trans_id == Transaction.id).where(*where)
+        ))
+        drop_rows('trans', ids)
+
+        db.session.execute(sqlalchemy.delete(Flow.__table__).where(Flow.trans_id.in_(ids)))
+        db.session.execute(sqlalchemy.delete(Record.__table__).where(Record.trans_id.in_(ids)))
+        # not through ids, mariadb can't select from the table it deletes from
+        db.session.execute(sqlalchemy.delete(Transaction.__table__).where(*where))
+        DataVersion.bump(current_user.id, ['trans', 'record', 'flow', 'agent'])
+
 
 class Record(db.Model, JSONModel):
     id = db.Column(db.Integer, primary_key=True)
@@ -216,6 +345,7 @@ class Record(db.Model, JSONModel):
 
     __table_args__ = (
         UniqueConstraint('category_id', 'trans_id'),
+        db.Index('ix_record_trans', 'trans_id'),
     )
 
     json_relations = ["trans", "category"]
@@ -237,9 +367,11 @@ class Flow(db.Model, JSONModel):
 
     __table_args__ = (
         UniqueConstraint('agent_id', 'trans_id'),
+        db.Index('ix_flow_trans', 'trans_id'),
     )
 
     json_relations = ["trans", "agent"]
+    json_preload = ["agent"]
 
 
 class AccountTransfer(db.Model, JSONModel):
@@ -260,10 +392,193 @@ class AccountTransfer(db.Model, JSONModel):
 
     __table_args__ = (
         CheckConstraint('src_id != dst_id'),
+        db.Index('ix_transfer_src_date', 'src_id', 'date_issued'),
+        db.Index('ix_transfer_dst_date', 'dst_id', 'date_issued'),
     )
 
     json_relations = ["src", "dst"]
 
+    def saldo_changes(self):
+        return [(self.src_id, -self.src_amount), (self.dst_id, self.dst_amount)]
+
+    @staticmethod
+    def delete_where(*criteria):
+        # set-based like Transaction.delete_where
+        where = [AccountTransfer.user_id == current_user.id, *criteria]
+        outgoing = db.session.execute(sqlalchemy.select(
+            AccountTransfer.src_id, -func.sum(AccountTransfer.src_amount)
+        ).where(*where).group_by(AccountTransfer.src_id)).all()
+        incoming = db.session.execute(sqlalchemy.select(
+            AccountTransfer.dst_id, func.sum(AccountTransfer.dst_amount)
+        ).where(*where).group_by(AccountTransfer.dst_id)).all()
+        AccountBalance.book(outgoing + incoming, sign=-1)
+        drop_rows('account_transfer', sqlalchemy.select(AccountTransfer.id).where(*where))
+        db.session.execute(sqlalchemy.delete(AccountTransfer.__table__).where(*where))
+        DataVersion.bump(current_user.id, ['account_transfer'])
+
+
+class AccountBalance(db.Model):
+    # sum of all changes to an account, created along with the account and
+    # kept up to date by the endpoints writing transactions and transfers,
+    # saldo = starting_saldo + delta
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), primary_key=True)
+    delta = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def book(changes: list[tuple[int, int]], sign=1):
+        # an atomic increment of the existing row, which also locks it until
+        # the end of the writer's transaction
+        for account_id, amount in changes:
+            if account_id is None or amount == 0:
+                continue
+            db.session.execute(
+                sqlalchemy.update(AccountBalance).where(
+                    AccountBalance.account_id == account_id
+                ).values(delta=AccountBalance.delta + sign * amount)
+            )
+
+    @staticmethod
+    def compute(account_id: int) -> int:
+        trans = db.session.query(func.coalesce(func.sum(sqlalchemy.case(
+            (Transaction.is_expense, -Transaction.amount), else_=Transaction.amount
+        )), 0)).filter(Transaction.account_id == account_id).scalar()
+        incoming = db.session.query(func.coalesce(func.sum(AccountTransfer.dst_amount), 0)
+            ).filter(AccountTransfer.dst_id == account_id).scalar()
+        outgoing = db.session.query(func.coalesce(func.sum(AccountTransfer.src_amount), 0)
+            ).filter(AccountTransfer.src_id == account_id).scalar()
+        return trans + incoming - outgoing
+
+    @staticmethod
+    def backfill():
+        # for accounts created before the balances existed
+        missing = db.session.query(Account.id).outerjoin(
+            AccountBalance, AccountBalance.account_id == Account.id
+        ).filter(AccountBalance.account_id.is_(None)).all()
+        for account_id, in missing:
+            db.session.add(AccountBalance(account_id=account_id, delta=AccountBalance.compute(account_id)))
+
+    @staticmethod
+    def drop(account_id: int):
+        AccountBalance.query.filter_by(account_id=account_id).delete()
+
+
+class MonthlyTotal(db.Model):
+    # record amounts summed per month and dimension for the nivo charts,
+    # kept up to date by the endpoints writing transactions
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'), primary_key=True)
+    is_expense = db.Column(db.Boolean, primary_key=True)
+    amount = db.Column(db.Integer, nullable=False)
+    # number of records, the row goes away with the last one
+    count = db.Column(db.Integer, nullable=False)
+
+    KEYS = ['user_id', 'currency_id', 'month', 'category_id', 'agent_id', 'is_expense']
+
+    @staticmethod
+    def book(totals: list[tuple[tuple, int]], sign=1):
+        merged = defaultdict(lambda: [0, 0])
+        for key, amount in totals:
+            merged[key][0] += amount
+            merged[key][1] += 1
+
+        if len(merged) == 0:
+            return
+        rows = [
+            dict(zip(MonthlyTotal.KEYS, key), amount=sign * amount, count=sign * count)
+            for key, (amount, count) in merged.items()
+        ]
+
+        # one statement for all keys, executed with the rows as parameters
+        table = MonthlyTotal.__table__
+        if db.engine.dialect.name == 'sqlite':
+            stmt = sqlite.insert(table)
+            stmt = stmt.on_conflict_do_update(index_elements=MonthlyTotal.KEYS, set_=dict(
+                amount=table.c.amount + stmt.excluded.amount,
+                count=table.c.count + stmt.excluded.count))
+        else:
+            stmt = mysql.insert(table)
+            stmt = stmt.on_duplicate_key_update(
+                amount=table.c.amount + stmt.inserted.amount,
+                count=table.c.count + stmt.inserted.count)
+        db.session.execute(stmt, rows)
+
+        if sign < 0:
+            db.session.execute(sqlalchemy.delete(table).where(
+                *[table.c[k] == sqlalchemy.bindparam(f'key_{k}') for k in MonthlyTotal.KEYS],
+                table.c.count <= 0
+            ), [{f'key_{k}': row[k] for k in MonthlyTotal.KEYS} for row in rows])
+
+    @staticmethod
+    def unbook(user_id: int, totals):
+        # set-based book(..., sign=-1), totals is a select of the KEYS along
+        # with the amount and count to take off
+        totals = totals.subquery()
+        table = MonthlyTotal.__table__
+        db.session.execute(sqlalchemy.update(table).where(
+            *[table.c[k] == totals.c[k] for k in MonthlyTotal.KEYS]
+        ).values(amount=table.c.amount - totals.c.amount, count=table.c.count - totals.c.count))
+        db.session.execute(sqlalchemy.delete(table).where(table.c.user_id == user_id, table.c.count <= 0))
+
+    @staticmethod
+    def month_of(column):
+        # sql side of the month in Transaction.monthly_totals
+        if db.engine.dialect.name == 'sqlite':
+            return func.strftime('%Y-%m', column)
+        return func.date_format(column, '%Y-%m')
+
+
+class DataVersion(db.Model):
+    # counter per user and table bumped with every write, cached responses
+    # built at an older version are stale
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    kind = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def get(user_id: int, *kinds) -> int:
+        # the sum grows with any write to one of the tables, all if none given
+        query = sqlalchemy.select(func.coalesce(func.sum(DataVersion.version), 0)).where(
+            DataVersion.user_id == user_id)
+        if len(kinds) > 0:
+            query = query.where(DataVersion.kind.in_(kinds))
+        return db.session.execute(query).scalar()
+
+    @staticmethod
+    def bump(user_id: int, kinds, connection=None):
+        table = DataVersion.__table__
+        for kind in kinds:
+            if db.engine.dialect.name == 'sqlite':
+                stmt = sqlite.insert(table).values(user_id=user_id, kind=kind, version=1)
+                stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'kind'], set_=dict(
+                    version=table.c.version + 1))
+            else:
+                stmt = mysql.insert(table).values(user_id=user_id, kind=kind, version=1)
+                stmt = stmt.on_duplicate_key_update(version=table.c.version + 1)
+            (db.session if connection is None else connection).execute(stmt)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def bump_data_version(session, flush_context):
+    # once per transaction and table, in the same transaction as the write
+    if not has_request_context() or not current_user.is_authenticated:
+        return
+    changed = [*session.new, *session.deleted, *filter(session.is_modified, session.dirty)]
+    bumped = session.info.setdefault('bumped_versions', set())
+    kinds = {obj.__table__.name for obj in changed} - bumped
+    if len(kinds) == 0:
+        return
+    DataVersion.bump(current_user.id, sorted(kinds), session.connection())
+    bumped.update(kinds)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def reset_data_version(session):
+    session.info.pop('bumped_versions', None)
+
 
 class Currency(db.Model, JSONModel):
     id = db.Column(db.Integer, primary_key=True)
@@ -287,20 +602,58 @@ class Agent(db.Model, JSONModel):
     desc = db.Column(db.String(64), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship("User", backref="agents")
+    # transactions plus flows referencing the agent, kept up to date by the
+    # endpoints writing them, see book
+    uses = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     __table_args__ = (
         UniqueConstraint('desc', 'user_id'),
+        db.Index('ix_agent_uses', 'user_id', sqlalchemy.desc('uses'), 'desc'),
     )
 
     json_relations = ["transactions", "flows"]
+    json_ignore = ["uses"]
+
+    @staticmethod
+    def book(changes: list[tuple[int, int]], sign=1):
+        # summed per agent first, an edit keeping its agents writes nothing
+        deltas = defaultdict(int)
+        for agent_id, uses in changes:
+            deltas[agent_id] += sign * uses
+        booked = db.session.info.setdefault('agent_uses', {}).setdefault(current_user.id, defaultdict(int))
+        by_delta = defaultdict(list)
+        for agent_id, delta in deltas.items():
+            if agent_id is None or delta == 0:
+                continue
+            by_delta[delta].append(agent_id)
+            # for the autocomplete index once committed
+            if booked is not None:
+                booked[agent_id] += delta
+        # one statement per distinct delta, on the table so that the orm
+        # doesn't search the session for the agents of every statement
+        table = Agent.__table__
+        for delta, agent_ids in by_delta.items():
+            db.session.execute(sqlalchemy.update(table).where(
+                table.c.id.in_(agent_ids)).values(uses=table.c.uses + delta))
 
-    @hybrid_property
-    def uses(self):
-        return len(self.transactions) + len(self.flows)
+    @staticmethod
+    def unbook(agent_ids):
+        # set-based book(..., sign=-1), agent_ids is a select of one agent_id per use
+        uses = agent_ids.subquery()
+        counts = sqlalchemy.select(uses.c.agent_id, func.count().label('uses')).group_by(uses.c.agent_id).subquery()
+        table = Agent.__table__
+        db.session.execute(sqlalchemy.update(table).where(
+            table.c.id == counts.c.agent_id).values(uses=table.c.uses - counts.c.uses))
+        # not known per agent, the autocomplete index is rebuilt instead
+        db.session.info.setdefault('agent_uses', {})[current_user.id] = None
 
-    @uses.expression
-    def uses(cls):
-        return func.count(Transaction.id) + func.count(Flow.id)
+    @staticmethod
+    def count_uses():
+        # what uses should be, for the rebuild command
+        return (
+            sqlalchemy.select(func.count(Transaction.id)).where(Transaction.agent_id == Agent.id).scalar_subquery()
+            + sqlalchemy.select(func.count(Flow.id)).where(Flow.agent_id == Agent.id).scalar_subquery()
+        )
 
 
 class Category(db.Model, JSONModel):
@@ -314,18 +667,86 @@ class Category(db.Model, JSONModel):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship("User", backref="categories")
 
-    # parent = db.relationship("Category", remote_side=[id])
+    # only to load the parents along with the categories, see parent
+    parent_category = db.relationship("Category", remote_side=[id], viewonly=True)
 
     @property
     def parent(self):
-        return Category.query.filter_by(id=self.parent_id, user_id=self.user_id).first()
+        if self.parent_id is None:
+            return None
+        # identity map lookup, no query if the parent is already loaded
+        parent = db.session.get(Category, self.parent_id)
+        return parent if parent is not None and parent.user_id == self.user_id else None
 
     __table_args__ = (
         UniqueConstraint('user_id', 'desc', 'is_expense'),
-        UniqueConstraint('user_id', 'order', 'is_expense')
+        UniqueConstraint('user_id', 'order', 'is_expense'),
+        db.Index('ix_category_order', 'user_id', 'is_expense', 'order'),
     )
 
     json_relations = ["records"]
+    json_ignore = ["parent_category"]
+    json_preload = ["parent_category"]
+
+
+class CategoryClosure(db.Model):
+    # one row per category and each of its ancestors including itself,
+    # kept up to date by the endpoints adding and moving categories
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_category_closure_descendant', 'descendant_id', 'ancestor_id'),
+    )
+
+    @staticmethod
+    def ancestors(category_id: int) -> list[tuple[int, int]]:
+        # (id, depth) of the category itself and everything above it
+        return db.session.query(CategoryClosure.ancestor_id, CategoryClosure.depth).filter(
+            CategoryClosure.descendant_id == category_id).all()
+
+    @staticmethod
+    def descendants(category_id: int) -> list[tuple[int, int]]:
+        # (id, depth) of the category itself and everything below it
+        return db.session.query(CategoryClosure.descendant_id, CategoryClosure.depth).filter(
+            CategoryClosure.ancestor_id == category_id).all()
+
+    @staticmethod
+    def attach(category_id: int, parent_id: int | None):
+        # a new leaf below parent_id, or a root
+        rows = [dict(ancestor_id=category_id, descendant_id=category_id, depth=0)]
+        if parent_id is not None:
+            rows += [
+                dict(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth + 1)
+                for ancestor_id, depth in CategoryClosure.ancestors(parent_id)
+            ]
+        db.session.execute(sqlalchemy.insert(CategoryClosure), rows)
+
+    @staticmethod
+    def move(category_id: int, parent_id: int | None):
+        # cut the subtree loose from its ancestors and hang it below parent_id
+        subtree = CategoryClosure.descendants(category_id)
+        ancestors = [
+            ancestor_id for ancestor_id, depth in CategoryClosure.ancestors(category_id) if depth > 0
+        ]
+        if len(ancestors) > 0:
+            db.session.execute(sqlalchemy.delete(CategoryClosure).where(
+                CategoryClosure.descendant_id.in_([id for id, _ in subtree]),
+                CategoryClosure.ancestor_id.in_(ancestors)))
+        if parent_id is None:
+            return
+        rows = [
+            dict(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=up + down + 1)
+            for ancestor_id, up in CategoryClosure.ancestors(parent_id)
+            for descendant_id, down in subtree
+        ]
+        db.session.execute(sqlalchemy.insert(CategoryClosure), rows)
+
+    @staticmethod
+    def is_below(category_id: int, ancestor_id: int) -> bool:
+        return db.session.get(CategoryClosure, (ancestor_id, category_id)) is not None
+
 
 class TransactionTemplate(db.Model, JSONModel):
     __tablename__ = 'template'
@@ -353,10 +774,12 @@ class TransactionTemplate(db.Model, JSONModel):
 
     __table_args__ = (
         UniqueConstraint('order', 'user_id'),
+        db.Index('ix_template_order', 'user_id', 'order'),
     )
 
     json_relations = ["agent", "remote_agent", "records", "flows"]
 
+
 class FlowTemplate(db.Model, JSONModel):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -372,6 +795,9 @@ class FlowTemplate(db.Model, JSONModel):
     agent = db.relationship("Agent")
     template = db.relationship("TransactionTemplate", backref="flows")
 
+    json_preload = ["agent"]
+
+
 class RecordTemplate(db.Model, JSONModel):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -381,4 +807,9 @@ class RecordTemplate(db.Model, JSONModel):
     ix = db.Column(db.Integer, nullable=False)
 
     category = db.relationship("Category")
-    template = db.relationship("TransactionTemplate", backref="records")
\ No newline at end of file
+    template = db.relationship("TransactionTemplate", backref="records")
+
+
+sqlalchemy.orm.configure_mappers()
+for model in JSONModel.__subclasses__():
+    model.compile_json()
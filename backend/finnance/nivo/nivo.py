@@ -1,16 +1,28 @@
 
 from calendar import monthrange
+from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import wraps
 from http import HTTPStatus
 
+import click
 import sqlalchemy
+from finnance.cache import ResponseCache, cached
+from finnance.categories import CategoryTree
 from finnance.errors import APIError
-from finnance.models import Agent, Category, Currency, Record, Transaction
-from flask import Blueprint, jsonify, request
+from finnance.models import Agent, Category, Currency, MonthlyTotal, Record, Transaction
+from flask import Blueprint, current_app, jsonify, request
 from flask_login import current_user, login_required
 
+from finnance import db
+
 nivo = Blueprint('nivo', __name__, url_prefix='/api/nivo')
+cache = ResponseCache()
+
+# sized by the app the blueprint gets registered on
+@nivo.record_once
+def configure(state):
+    cache.max_bytes = state.app.config['NIVO_CACHE_BYTES']
 
 def nivo_wrapper(foo):
     @wraps(foo)
@@ -53,73 +65,171 @@ def is_expense_wrapper(foo):
         return foo(**kwargs, is_expense=is_expense)
     return wrapper
 
+def end_of_month(dt: datetime):
+    return datetime(dt.year, dt.month, monthrange(dt.year, dt.month)[1], 23, 59, 59) + timedelta(seconds=1)
+
+GRANULARITIES = ['day', 'week', 'month', 'quarter', 'year']
+
+def next_bucket(dt: datetime, granularity: str):
+    day = datetime(dt.year, dt.month, dt.day)
+    if granularity == 'day':
+        return day + timedelta(days=1)
+    if granularity == 'week':
+        return day + timedelta(days=7 - dt.weekday())
+    if granularity == 'month':
+        return end_of_month(dt)
+    if granularity == 'quarter':
+        month = (dt.month - 1) // 3 * 3 + 3
+        return datetime(dt.year + month // 12, month % 12 + 1, 1)
+    return datetime(dt.year + 1, 1, 1)
+
+def buckets(min_date: datetime, max_date: datetime, granularity: str):
+    # [(start, end)] covering the range, the first one starting at min_date
+    out = []
+    start = min_date
+    end = next_bucket(start, granularity)
+    while start < max_date:
+        out.append((start, end))
+        start = end
+        end = min(next_bucket(start, granularity), max_date)
+    return out
+
+def bucket_key(dt: datetime, granularity: str):
+    # python side of bucket_of
+    if granularity == 'day':
+        return dt.strftime('%Y-%m-%d')
+    if granularity == 'week':
+        return (dt - timedelta(days=dt.weekday())).strftime('%Y-%m-%d')
+    if granularity == 'month':
+        return dt.strftime('%Y-%m')
+    if granularity == 'quarter':
+        return f'{dt.year}-{(dt.month - 1) // 3 + 1}'
+    return dt.strftime('%Y')
+
+def bucket_of(column, granularity: str):
+    # string key of the bucket a datetime column falls into, see bucket_key
+    func = sqlalchemy.func
+    if db.engine.dialect.name == 'sqlite':
+        if granularity == 'week':
+            return func.date(column, 'weekday 0', '-6 days')
+        if granularity == 'quarter':
+            quarter = (sqlalchemy.cast(func.strftime('%m', column), sqlalchemy.Integer) + 2) // 3
+            return func.strftime('%Y', column, type_=sqlalchemy.String).concat('-').concat(
+                sqlalchemy.cast(quarter, sqlalchemy.String))
+        return func.strftime({'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}[granularity], column)
+    if granularity == 'week':
+        return func.date_format(func.subdate(func.date(column), func.weekday(column)), '%Y-%m-%d')
+    if granularity == 'quarter':
+        return func.concat(func.year(column), '-', func.quarter(column))
+    return func.date_format(column, {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}[granularity])
+
+def granularity_wrapper(foo):
+    @wraps(foo)
+    def wrapper(**kwargs):
+        granularity = request.args.get('granularity', 'month')
+        if granularity not in GRANULARITIES:
+            raise APIError(HTTPStatus.BAD_REQUEST, f"granularity must be one of {', '.join(GRANULARITIES)}")
+        return foo(**kwargs, granularity=granularity)
+    return wrapper
+
+def record_totals(currency: Currency, min_date: datetime, max_date: datetime, *keys, granularity='month'):
+    # record amounts summed by keys out of category_id, agent_id, is_expense
+    # and bucket, whole months come from MonthlyTotal and only the partial
+    # months at the edges of the range from the records themselves
+    raw_columns = dict(category_id=Record.category_id, agent_id=Transaction.agent_id,
+                       is_expense=Transaction.is_expense)
+    first = datetime(min_date.year, min_date.month, 1)
+    if first < min_date:
+        first = end_of_month(min_date)
+    last = datetime(max_date.year, max_date.month, 1)
+    use_totals = first < last and granularity not in ['day', 'week']
+    if not use_totals:
+        first = last = max_date
+
+    columns = [
+        bucket_of(Transaction.date_issued, granularity).label(key) if key == 'bucket' else raw_columns[key]
+        for key in keys
+    ]
+    raw = db.session.query(
+        *columns, sqlalchemy.func.sum(Record.amount)
+    ).join(Transaction, Record.trans_id == Transaction.id).filter(
+        Transaction.currency_id == currency.id,
+        sqlalchemy.or_(
+            sqlalchemy.and_(Transaction.date_issued >= min_date, Transaction.date_issued < first),
+            sqlalchemy.and_(Transaction.date_issued >= last, Transaction.date_issued < max_date),
+        )
+    ).group_by(*columns)
+
+    totals = defaultdict(int)
+    for *key, value in raw:
+        totals[tuple(key)] += int(value)
+
+    if use_totals:
+        columns = [getattr(MonthlyTotal, 'month' if key == 'bucket' else key) for key in keys]
+        rows = db.session.query(
+            *columns, sqlalchemy.func.sum(MonthlyTotal.amount)
+        ).filter(
+            MonthlyTotal.user_id == current_user.id,
+            MonthlyTotal.currency_id == currency.id,
+            MonthlyTotal.month >= bucket_key(first, 'month'),
+            MonthlyTotal.month < bucket_key(last, 'month'),
+        ).group_by(*columns)
+        for *key, value in rows:
+            if 'bucket' in keys:
+                i = keys.index('bucket')
+                key[i] = bucket_key(datetime.strptime(key[i], '%Y-%m'), granularity)
+            totals[tuple(key)] += int(value)
+
+    return dict(totals)
+
 @nivo.route("/sunburst")
 @login_required
+@cached(cache)
 @nivo_wrapper
 @is_expense_wrapper
 def sunburst(currency: Currency, is_expense: bool, min_date: datetime, max_date: datetime):
-    def agents(cat, path):
-        query = Agent.query.join(Transaction).join(Record).join(Category
-            ).filter(Transaction.currency_id == currency.id).filter(Category.id == cat.id)
-        if min_date is not None:
-            query = query.filter(Transaction.date_issued >= min_date)
-        if max_date is not None:
-            query = query.filter(Transaction.date_issued < max_date)
-        query = query.group_by(Agent).with_entities(
-                sqlalchemy.func.sum(Record.amount).label('value'), 
-                Agent.desc.label('name')
-            )
-        return [
-            dict(
-                color=cat.color,
-                id=f'{path}.{row._asdict()["name"]}',
-                **row._asdict()
-            )
-            for row in query
-        ]
+    tree = CategoryTree.load()
+    totals = record_totals(currency, min_date, max_date, 'category_id', 'agent_id')
+    names = dict(db.session.query(Agent.id, Agent.desc).filter(
+        Agent.id.in_({agent_id for _, agent_id in totals})))
+    agents = defaultdict(list)
+    for (category_id, agent_id), value in sorted(totals.items(), key=lambda kv: kv[0][1]):
+        agents[category_id].append(dict(name=names[agent_id], value=value))
 
     def cat_obj(cat: Category, path=''):
-        cat_children = Category.query.filter_by(parent_id=cat.id, user_id=current_user.id).order_by(Category.order).all()
-
         path = f'{path}.{cat.desc}'
-        children = [
-            cat_obj(ch, path=path) for ch in cat_children
-        ] + agents(cat, path)
-        
         return {
             'id': path,
             'name': cat.desc,
             'color': cat.color,
-            'children': children,
+            'children': [
+                cat_obj(ch, path=path) for ch in tree.children(cat)
+            ] + [
+                dict(color=cat.color, id=f'{path}.{agent["name"]}', **agent)
+                for agent in agents[cat.id]
+            ],
         }
 
-    data = []
-    for cat in Category.query.filter_by(parent_id=None, user_id=current_user.id, is_expense=is_expense
-                                        ).order_by(Category.order):
-        obj = cat_obj(cat)
-        data.append(obj)
+    data = [
+        cat_obj(cat) for cat in tree.roots(is_expense)
+    ]
     return jsonify({'id': 'sunburst', 'color': '#ff0000', 'children': data})
 
 @nivo.route("/bars")
 @login_required
+@cached(cache)
 @nivo_wrapper
 @is_expense_wrapper
 def bars(currency: Currency, is_expense: bool, min_date: datetime, max_date: datetime):
-        
-    def value(cat):
-        query = Category.query.filter_by(id=cat.id).join(Record).join(
-            Transaction).filter_by(currency_id=currency.id)
-        if min_date is not None:
-            query = query.filter(Transaction.date_issued >= min_date)
-        if max_date is not None:
-            query = query.filter(Transaction.date_issued < max_date)
-        query = query.group_by(Category).with_entities(
-                sqlalchemy.func.sum(Record.amount).label('value'), 
-            )
-        row = query.first()
-        if row is None:
-            return 0
-        return row._asdict()['value']
+    tree = CategoryTree.load()
+    sums = {
+        category_id: value
+        for (category_id,), value in record_totals(currency, min_date, max_date, 'category_id').items()
+    }
+    colors = {
+        cat.desc: cat.color
+        for cat in tree.by_id.values() if cat.is_expense == is_expense
+    }
 
     keys = []
     values = []
@@ -132,29 +242,26 @@ def bars(currency: Currency, is_expense: bool, min_date: datetime, max_date: dat
             'color': cat.color,
         }
 
-        def children(parent):
-            prevSum = sum(values)
-            v = value(parent)
+        def add(parent):
+            total = 0
+            v = sums.get(parent.id, 0)
             if v > 0:
                 keys.append(parent.desc)
                 values.append(v)
-                bar[parent.desc] = value(parent)
+                bar[parent.desc] = v
                 bar[f"{parent.desc}_color"] = parent.color
-            cat_children = Category.query.filter_by(parent_id=parent.id, user_id=current_user.id).order_by(Category.order).all()
-            for child in cat_children:
-                children(child)
-            if parent.parent is None:
-                myTotal = sum(values) - prevSum
-                bar_totals[parent.desc] = myTotal
-            
-        children(cat)
+                total += v
+            for child in tree.children(parent):
+                total += add(child)
+            return total
+
+        bar_totals[cat.desc] = add(cat)
         if len(bar.keys()) == 2:
             return None
         return bar
 
     data = []
-    for cat in Category.query.filter_by(parent_id=None, user_id=current_user.id, is_expense=is_expense
-                                        ).order_by(Category.order):
+    for cat in tree.roots(is_expense):
         bar = bar_obj(cat)
         if bar is not None:
             data.append(bar)
@@ -164,9 +271,7 @@ def bars(currency: Currency, is_expense: bool, min_date: datetime, max_date: dat
         for bar in data:
             if key not in bar:
                 bar[key] = 0
-                bar[f"{key}_color"] =  Category.query.filter_by(
-                    desc=key, is_expense=is_expense, user_id=current_user.id
-                ).first().color
+                bar[f"{key}_color"] = colors[key]
 
     big3 = [kv[0] for kv in sorted(bar_totals.items(), key=lambda kv: kv[1], reverse=True)[:3]]
     if len(data) > 3:
@@ -188,22 +293,27 @@ def bars(currency: Currency, is_expense: bool, min_date: datetime, max_date: dat
 
     return jsonify({'data': data, 'keys': keys, 'total': sum(values)})
 
-def end_of_month(dt: datetime):
-    return datetime(dt.year, dt.month, monthrange(dt.year, dt.month)[1], 23, 59, 59) + timedelta(seconds=1)
-
 @nivo.route("/divbars")
 @login_required
+@cached(cache)
 @nivo_wrapper
 def diverging_bars(currency: Currency, min_date: datetime, max_date: datetime):
-    
+    months = buckets(min_date, max_date, 'month')
+    if len(months) == 0:
+        return jsonify({'data': [], 'keys': []})
+
+    tree = CategoryTree.load()
+    sums = record_totals(currency, min_date, months[-1][1], 'bucket', 'category_id')
+
     data = []
     keys = []
 
-    start = min_date
-    end = end_of_month(start)
-    while start < max_date:
+    for start, end in months:
+        month = bucket_key(start, 'month')
         bar = {
-            'month': start.isoformat()
+            'month': start.isoformat(),
+            'total_expenses': 0,
+            'total_income': 0,
         }
 
         def add_total(cat: Category):
@@ -214,30 +324,22 @@ def diverging_bars(currency: Currency, min_date: datetime, max_date: datetime):
                 key = cat.desc
             if key not in keys:
                 keys.append(key)
-            row = Record.query.filter_by(category_id=cat.id).join(
-                Transaction).filter_by(currency_id=currency.id).filter(Transaction.date_issued >= start).filter(Transaction.date_issued < end
-                ).with_entities(sqlalchemy.func.sum(Record.amount).label('value')).first()
 
-            total = row._asdict()['value']
-            if total is None:
-                total = 0
+            total = sums.get((month, cat.id), 0)
             if cat.is_expense:
                 bar[key] = total
-                bar['total_expenses'] = bar.get('total_expenses', 0) + total
+                bar['total_expenses'] += total
             else:
                 bar[key] = -total
-                bar['total_income'] = bar.get('total_income', 0) + total
+                bar['total_income'] += total
 
             bar[f"{key}_color"] = cat.color
-            for child in Category.query.filter_by(
-                user_id=current_user.id, parent_id=cat.id).order_by(Category.order.desc()):
+            for child in tree.children(cat)[::-1]:
                 add_total(child)
 
-        for cat in Category.query.filter_by(user_id=current_user.id, 
-                                            is_expense=True, parent_id=None).order_by(Category.order.desc()):
+        for cat in tree.roots(True)[::-1]:
             add_total(cat)
-        for cat in Category.query.filter_by(user_id=current_user.id, 
-                                            is_expense=False, parent_id=None).order_by(Category.order.desc()):
+        for cat in tree.roots(False)[::-1]:
             add_total(cat)
 
         bar['total_exp'] = sum([
@@ -248,10 +350,6 @@ def diverging_bars(currency: Currency, min_date: datetime, max_date: datetime):
         ])
 
         data.append(bar)
-        start = end
-        end = end_of_month(start)
-        if end > max_date:
-            end = max_date
 
     cut = 0
     while cut < len(data) and data[cut]['total_expenses'] == 0 and data[cut]['total_income'] == 0:
@@ -263,47 +361,25 @@ def diverging_bars(currency: Currency, min_date: datetime, max_date: datetime):
 
 @nivo.route("/line")
 @login_required
+@cached(cache)
 @nivo_wrapper
-def line(currency: Currency, min_date: datetime, max_date: datetime):
-    start = min_date
-    end = end_of_month(start)
-
-    data = []
+@granularity_wrapper
+def line(currency: Currency, min_date: datetime, max_date: datetime, granularity: str):
+    periods = buckets(min_date, max_date, granularity)
+    if len(periods) == 0:
+        return jsonify([])
 
-    while start < max_date:
+    sums = record_totals(currency, min_date, periods[-1][1], 'bucket', 'is_expense',
+                         granularity=granularity)
 
-        exp = Record.query.with_entities(
-             sqlalchemy.func.sum(Record.amount).label("sum")
-        ).join(Transaction).filter_by(
-            currency_id=currency.id,
-            is_expense=True
-        ).filter(
-            Transaction.date_issued >= start
-        ).filter(
-            Transaction.date_issued < end
-        ).first()
-        inc = Record.query.with_entities(
-             sqlalchemy.func.sum(Record.amount).label("sum")
-        ).join(Transaction).filter_by(
-            currency_id=currency.id,
-            is_expense=False
-        ).filter(
-            Transaction.date_issued >= start
-        ).filter(
-            Transaction.date_issued < end
-        ).first()
-        month = {
-            'expenses': 0 if exp is None or exp.sum is None else exp.sum,
-            'income': 0 if inc is None or inc.sum is None else inc.sum,
+    data = []
+    for start, end in periods:
+        key = bucket_key(start, granularity)
+        data.append({
+            'expenses': sums.get((key, True), 0),
+            'income': sums.get((key, False), 0),
             'month': start.isoformat()
-        }
-
-        data.append(month)
-        
-        start = end
-        end = end_of_month(start)
-        if end > max_date:
-            end = max_date
+        })
 
     cut = 0
     while cut < len(data) and data[cut]['expenses'] == 0 and data[cut]['income'] == 0:
@@ -314,39 +390,64 @@ def line(currency: Currency, min_date: datetime, max_date: datetime):
 
 @nivo.route("/categories")
 @login_required
+@cached(cache)
 @nivo_wrapper
 @is_expense_wrapper
 def categories(currency: Currency, is_expense: bool, min_date: datetime, max_date: datetime):
     positive = lambda d: d['total'] > 0
 
+    tree = CategoryTree.load()
+    sums = {
+        category_id: value
+        for (category_id,), value in record_totals(currency, min_date, max_date, 'category_id').items()
+    }
+
     def compute(cat: Category):
-        query = Record.query.filter_by(
-            category_id=cat.id
-        ).with_entities(
-             sqlalchemy.func.sum(Record.amount).label("total")
-        ).join(Transaction).filter_by(
-            currency_id=currency.id
-        ).filter(
-            Transaction.date_issued >= min_date
-        ).filter(
-            Transaction.date_issued < max_date
-        ).first()
-        total = 0 if query is None or query.total is None else query.total
-        children = list(filter(positive, [
-                compute(cat) for cat in Category.query.filter_by(parent_id=cat.id, user_id=current_user.id)
-            ]))
-        totaltotal = total + sum([d['total'] for d in children])
+        # children first, so totals roll up bottom-up
+        cat_children = list(filter(positive, [
+            compute(child) for child in tree.children(cat)
+        ]))
         return {
             'category': cat.json(deep=False),
-            'total': totaltotal,
-            'children': children
+            'total': sums.get(cat.id, 0) + sum([d['total'] for d in cat_children]),
+            'children': cat_children
         }
-    
+
     data = list(filter(positive, [
-        compute(cat) for cat in Category.query.filter_by(
-            parent_id=None, user_id=current_user.id, is_expense=is_expense
-        )
+        compute(cat) for cat in tree.roots(is_expense)
     ]))
 
     return jsonify(data)
 
+
+@nivo.route("/cache")
+@login_required
+def cache_stats():
+    # the stats of this worker's cache cover every user's requests, only
+    # for looking at them while developing
+    if not current_app.debug:
+        raise APIError(HTTPStatus.NOT_FOUND)
+    return jsonify(cache.stats())
+
+def rebuild_monthly_totals():
+    table = MonthlyTotal.__table__
+    db.session.execute(sqlalchemy.delete(table))
+    month = bucket_of(Transaction.date_issued, 'month')
+    db.session.execute(sqlalchemy.insert(table).from_select(
+        MonthlyTotal.KEYS + ['amount', 'count'],
+        sqlalchemy.select(
+            Transaction.user_id, Transaction.currency_id, month, Record.category_id,
+            Transaction.agent_id, Transaction.is_expense,
+            sqlalchemy.func.sum(Record.amount), sqlalchemy.func.count()
+        ).join(Transaction, Record.trans_id == Transaction.id).group_by(
+            Transaction.user_id, Transaction.currency_id, month, Record.category_id,
+            Transaction.agent_id, Transaction.is_expense
+        )
+    ))
+    db.session.commit()
+
+@nivo.cli.command('monthly-totals')
+def rebuild_monthly_totals_command():
+    """Rebuild the monthly record totals from scratch."""
+    rebuild_monthly_totals()
+    click.echo('monthly totals rebuilt')
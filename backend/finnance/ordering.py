@@ -0,0 +1,80 @@
+from http import HTTPStatus
+
+import sqlalchemy
+from flask_login import current_user
+
+from finnance import db
+from finnance.errors import APIError
+from finnance.models import DataVersion
+
+# orders are handed out this far apart, so that a move fits between two
+# neighbours without renumbering anything else
+GAP = 1024
+
+def next_order(model, *scope) -> int:
+    top = db.session.query(sqlalchemy.func.max(model.order)).filter(*scope).scalar()
+    return (top if top is not None else 0) + GAP
+
+def respace(model, *scope):
+    # renumber the scope GAP apart, keeping the order, parked on negative
+    # orders first as mariadb checks the unique constraint row by row
+    table = model.__table__
+    ranked = sqlalchemy.select(
+        model.id, sqlalchemy.func.row_number().over(order_by=model.order).label('rank')
+    ).where(*scope).subquery()
+    db.session.execute(sqlalchemy.update(table).where(
+        table.c.id == ranked.c.id).values(order=-ranked.c.rank * GAP))
+    db.session.execute(sqlalchemy.update(table).where(
+        *scope, table.c.order < 0).values(order=-table.c.order))
+    DataVersion.bump(current_user.id, [table.name])
+
+def move(item, scope: list, before: int = None, after: int = None):
+    # puts item right before or after another row of the scope, writing
+    # item's order only unless the gap there ran out
+    model = type(item)
+    if (before is None) == (after is None):
+        raise APIError(HTTPStatus.BAD_REQUEST, "either before or after must be given")
+    other = model.query.filter(*scope, model.id == (before if before is not None else after)).first()
+    if other is None or other is item:
+        raise APIError(HTTPStatus.BAD_REQUEST, f"invalid {'before' if before is not None else 'after'}")
+
+    others = [*scope, model.id != item.id]
+    while True:
+        if before is not None:
+            low = db.session.query(sqlalchemy.func.max(model.order)).filter(
+                *others, model.order < other.order).scalar()
+            low, high = low if low is not None else 0, other.order
+        else:
+            high = db.session.query(sqlalchemy.func.min(model.order)).filter(
+                *others, model.order > other.order).scalar()
+            low, high = other.order, high if high is not None else other.order + 2 * GAP
+        if high - low >= 2:
+            item.order = (low + high) // 2
+            return
+        respace(model, *scope)
+        db.session.expire(item, ['order'])
+        db.session.expire(other, ['order'])
+
+def reorder(model, scope: list, ids: list[int], orders: list[int]) -> int:
+    # bulk variant, sets the orders of all changed rows at once
+    name = model.__table__.name
+    if len(orders) != len(ids):
+        raise APIError(HTTPStatus.BAD_REQUEST, "orders and ids must have same length")
+    if any(order < 0 for order in orders):
+        raise APIError(HTTPStatus.BAD_REQUEST, "order must be non-negative")
+    if len(set(ids)) != len(ids):
+        raise APIError(HTTPStatus.BAD_REQUEST, "ids must be unique")
+    current = dict(db.session.query(model.id, model.order).filter(*scope, model.id.in_(ids)))
+    if len(current) != len(ids):
+        raise APIError(HTTPStatus.BAD_REQUEST, f"non-existent {name} id")
+    changed = {id: order for id, order in zip(ids, orders) if current[id] != order}
+    if len(changed) == 0:
+        return 0
+
+    table = model.__table__
+    db.session.execute(sqlalchemy.update(table).where(
+        table.c.id.in_(changed)).values(order=-1 - table.c.order))
+    db.session.execute(sqlalchemy.update(table).where(
+        table.c.id.in_(changed)).values(order=sqlalchemy.case(changed, value=table.c.id)))
+    DataVersion.bump(current_user.id, [name])
+    return len(changed)
@@ -1,6 +1,8 @@
 from datetime import datetime
 from http import HTTPStatus
+from math import ceil
 
+import sqlalchemy
 from finnance.errors import APIError
 
 class ModelID:
@@ -10,6 +12,17 @@ class ModelID:
         else:
             self.id = int(id_param)
 
+class Cursor:
+    # keyset pagination position '<date_issued>,<id>' of the last row seen
+    def __init__(self, cursor_param):
+        date_issued, id = cursor_param.rsplit(',', 1)
+        self.date_issued = datetime.fromisoformat(date_issued)
+        self.id = int(id)
+
+    @staticmethod
+    def of(date_issued: datetime, id: int):
+        return f'{date_issued.isoformat()},{id}'
+
 def parseSearchParams(params: dict[str, str], template: dict[str, type]):
     template.update(pagesize=int, page=int)
     parsed = dict(pagesize=10, page=0)
@@ -22,4 +35,16 @@ def parseSearchParams(params: dict[str, str], template: dict[str, type]):
                     parsed[key] = template[key](val)
             except ValueError:
                 raise APIError(HTTPStatus.BAD_REQUEST, f'invalid search param {key}')
-    return parsed
\ No newline at end of file
+    return parsed
+
+def paginate(query, date_column, id_column, pagesize: int, page: int, before: Cursor = None):
+    pages = ceil(query.order_by(None).count() / pagesize)
+    query = query.order_by(date_column.desc(), id_column.desc())
+    if before is not None:
+        query = query.filter(sqlalchemy.or_(
+            date_column < before.date_issued,
+            sqlalchemy.and_(date_column == before.date_issued, id_column < before.id)
+        ))
+    else:
+        query = query.offset(pagesize*page)
+    return pages, query.limit(pagesize).all()
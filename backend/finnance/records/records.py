@@ -1,8 +1,8 @@
 from datetime import datetime
-from math import ceil
 
-from finnance.params import parseSearchParams
-from finnance.models import Record, Transaction, JSONModel
+from finnance.params import Cursor, paginate, parseSearchParams
+from finnance.search import matches
+from finnance.models import Category, Record, Transaction, JSONModel
 from flask import Blueprint, request
 from flask_login import current_user, login_required
 
@@ -12,30 +12,28 @@ records = Blueprint('records', __name__, url_prefix='/api/records')
 @login_required
 def get_records():
     kwargs = parseSearchParams(request.args.to_dict(), dict(
-        start=datetime, end=datetime, search=str
+        start=datetime, end=datetime, search=str, before=Cursor
     ))
 
-    result = Record.query.join(Transaction).filter_by(user_id=current_user.id).order_by(Transaction.date_issued.desc())
+    result = Record.query.options(*Record.json_options()).join(Transaction).filter_by(user_id=current_user.id)
     if 'start' in kwargs:
         result = result.filter(Transaction.date_issued >= kwargs.get('start'))
     if 'end' in kwargs:
         result = result.filter(Transaction.date_issued < kwargs.get('end'))
-    
-    pagesize = kwargs.get('pagesize')
-    page = kwargs.get('page')
 
-    # search filter
-    result = list(filter(
-        lambda r: 'search' not in kwargs or any(
-            kwargs['search'].lower() in string for string in [
-                r.trans.comment.lower(),
-                r.category.desc.lower(),
-        ]),
-        result.all()
-    ))
+    # search filter
+    if 'search' in kwargs:
+        result = result.join(Category, Record.category_id == Category.id).filter(
+            matches(kwargs['search'],
+                ('trans', Record.trans_id, Transaction.comment),
+                ('category', Record.category_id, Category.desc)))
+
+    pages, result = paginate(result, Transaction.date_issued, Record.id,
+                             kwargs.get('pagesize'), kwargs.get('page'), kwargs.get('before'))
     return JSONModel.obj_to_api(dict(
-        pages= ceil(len(result) / pagesize),
+        pages=pages,
+        next=Cursor.of(result[-1].trans.date_issued, result[-1].id) if len(result) else None,
         records=[
         record.json(deep=True)
-        for record in result[pagesize*page:pagesize*(page+1)]
+        for record in result
     ]))
\ No newline at end of file
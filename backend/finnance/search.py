@@ -0,0 +1,148 @@
+import sqlite3
+
+import click
+import sqlalchemy
+from flask.cli import with_appcontext
+from flask_login import current_user
+
+from finnance import db
+
+# searchable text column of every indexed table
+INDEXED = {
+    'trans': 'comment',
+    'account_transfer': 'comment',
+    'agent': 'desc',
+    'account': 'desc',
+    'category': 'desc',
+}
+
+
+class SearchTrigram(db.Model):
+    # one row per distinct lowercase trigram of an indexed text, binary
+    # so that trigrams differing only in accents don't collide on mariadb
+    kind = db.Column(db.String(32), primary_key=True)
+    ref_id = db.Column(db.Integer, primary_key=True)
+    trigram = db.Column(db.VARBINARY(12), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_search_trigram_lookup', 'user_id', 'kind', 'trigram', 'ref_id'),
+    )
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'connect')
+def register_py_lower(dbapi_connection, connection_record):
+    # sqlite's lower() only folds ascii, py_lower folds like python does so
+    # that searching über finds Überraschung, lower() itself stays untouched
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            'py_lower', 1, lambda text: text.lower() if isinstance(text, str) else text, deterministic=True)
+
+def searchFilter(search: str, *columns):
+    # case-insensitive substring match on any of the columns
+    lower = sqlalchemy.func.py_lower if db.engine.dialect.name == 'sqlite' else sqlalchemy.func.lower
+    return sqlalchemy.or_(*[
+        lower(column).contains(search.lower(), autoescape=True)
+        for column in columns
+    ])
+
+
+def trigrams(text: str) -> set[bytes]:
+    # str.lower, the same folding as searchFilter, which uses python's on
+    # sqlite too, so that candidates aren't thrown away again
+    text = text.lower()
+    return {text[i:i+3].encode() for i in range(len(text) - 2)}
+
+
+def entries(obj) -> list[dict]:
+    kind = obj.__table__.name
+    return [
+        dict(kind=kind, ref_id=obj.id, trigram=trigram, user_id=obj.user_id)
+        for trigram in trigrams(getattr(obj, INDEXED[kind]))
+    ]
+
+
+def index_rows(kind: str, rows):
+    # for (id, text, user_id) rows written around the orm
+    entries = [
+        dict(kind=kind, ref_id=id, trigram=trigram, user_id=user_id)
+        for id, text, user_id in rows for trigram in trigrams(text)
+    ]
+    if len(entries) > 0:
+        db.session.execute(sqlalchemy.insert(SearchTrigram), entries)
+
+
+def drop_rows(kind: str, ids):
+    # for rows deleted around the orm, ids is a select of their ids
+    db.session.execute(sqlalchemy.delete(SearchTrigram.__table__).where(
+        SearchTrigram.kind == kind, SearchTrigram.ref_id.in_(ids)))
+
+
+def candidates(kind: str, grams: set[bytes]):
+    return sqlalchemy.select(SearchTrigram.ref_id).where(
+        SearchTrigram.user_id == current_user.id,
+        SearchTrigram.kind == kind,
+        SearchTrigram.trigram.in_(grams)
+    ).group_by(SearchTrigram.ref_id).having(sqlalchemy.func.count() == len(grams))
+
+
+def matches(search: str, *fields):
+    # fields are (kind, id column, text column) triples, the index narrows
+    # down the rows and the LIKE on the text column confirms the substring
+    grams = trigrams(search)
+    clauses = []
+    for kind, id_column, text_column in fields:
+        clause = searchFilter(search, text_column)
+        # too short to have a trigram, nothing to narrow down
+        if len(grams) > 0:
+            clause = sqlalchemy.and_(id_column.in_(candidates(kind, grams)), clause)
+        clauses.append(clause)
+    return sqlalchemy.or_(*clauses)
+
+
+def indexed(obj) -> bool:
+    return getattr(obj, '__table__', None) is not None and obj.__table__.name in INDEXED
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def sync(session, flush_context):
+    # keeps the index in sync with every write through the orm
+    stale = [obj for obj in session.deleted if indexed(obj)]
+    fresh = [obj for obj in session.new if indexed(obj)]
+    for obj in session.dirty:
+        if indexed(obj) and sqlalchemy.inspect(obj).attrs[
+                INDEXED[obj.__table__.name]].history.has_changes():
+            stale.append(obj)
+            fresh.append(obj)
+
+    connection = session.connection()
+    for obj in stale:
+        connection.execute(sqlalchemy.delete(SearchTrigram.__table__).where(
+            SearchTrigram.kind == obj.__table__.name, SearchTrigram.ref_id == obj.id))
+    rows = [row for obj in fresh for row in entries(obj)]
+    if len(rows) > 0:
+        connection.execute(sqlalchemy.insert(SearchTrigram.__table__), rows)
+
+
+def rebuild():
+    db.session.execute(sqlalchemy.delete(SearchTrigram))
+    for kind, column in INDEXED.items():
+        table = db.metadata.tables[kind]
+        last_id = 0
+        while True:
+            chunk = db.session.execute(sqlalchemy.select(
+                table.c.id, table.c[column], table.c.user_id
+            ).where(table.c.id > last_id).order_by(table.c.id).limit(1000)).all()
+            if len(chunk) == 0:
+                break
+            index_rows(kind, chunk)
+            last_id = chunk[-1].id
+    db.session.commit()
+
+
+@click.command('search-index')
+@with_appcontext
+def rebuild_command():
+    """Rebuild the search index from scratch."""
+    rebuild()
+    click.echo('search index rebuilt')
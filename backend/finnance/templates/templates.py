@@ -1,10 +1,12 @@
-from datetime import datetime
 from http import HTTPStatus
 
-from finnance.agents import create_agent_ifnx
+import sqlalchemy
+from finnance.agents import resolve_agents
+from finnance.cache import etag
 from finnance.errors import APIError, validate
-from finnance.models import (Account, Category, Currency, FlowTemplate,
+from finnance.models import (Account, Category, Currency, DataVersion, FlowTemplate,
                              JSONModel, RecordTemplate, TransactionTemplate)
+from finnance.ordering import move, next_order, reorder
 from flask import Blueprint, jsonify
 from flask_login import current_user, login_required
 
@@ -14,8 +16,9 @@ templates = Blueprint('templates', __name__, url_prefix='/api/templates')
 
 @templates.route("")
 @login_required
+@etag('template', 'record_template', 'flow_template', 'agent')
 def all_templates():
-    temps = TransactionTemplate.query.filter_by(
+    temps = TransactionTemplate.query.options(*TransactionTemplate.json_options()).filter_by(
         user_id=current_user.id).order_by(TransactionTemplate.order.asc()).all()
     return JSONModel.obj_to_api([temp.json(deep=True) for temp in temps])
 
@@ -69,7 +72,7 @@ def add_template(**data):
             raise APIError(HTTPStatus.BAD_REQUEST, 'account and currency don\'t match')
 
     if 'currency_id' in data:
-        currency = Currency.query.filter_by(id=data['currency_id'], user_id=current_user.id)
+        currency = Currency.query.filter_by(id=data['currency_id'], user_id=current_user.id).first()
         if currency is None:
             raise APIError(HTTPStatus.BAD_REQUEST, 'invalid currency_id')
     
@@ -81,32 +84,27 @@ def add_template(**data):
         if cat is None:
             raise APIError(HTTPStatus.BAD_REQUEST, 'invalid category_id')
     
+    flows = data.pop('flows', [])
+    if 'remote_agent' in data:
+        flows = []
+    agents = resolve_agents([data.get('agent'), data.get('remote_agent')] + [flow.get('agent') for flow in flows])
+
     if 'agent' in data:
-        agent = create_agent_ifnx(data.pop('agent'))
-        data['agent_id'] = agent.id
+        data['agent_id'] = agents[data.pop('agent')].id
     
     if 'remote_agent' in data:
-        agent = create_agent_ifnx(data.pop('remote_agent'))
-        data['remote_agent_id'] = agent.id
-        flows = []
-    else:
-        flows = data.pop('flows')
+        data['remote_agent_id'] = agents[data.pop('remote_agent')].id
 
     for flow in flows:
-        flow['agent_id'] = create_agent_ifnx(flow.pop('agent')).id if 'agent' in flow else None
+        flow['agent_id'] = agents[flow.pop('agent')].id if 'agent' in flow else None
 
-    order = max([temp.order for temp in current_user.templates] + [0]) + 1
+    order = next_order(TransactionTemplate, TransactionTemplate.user_id == current_user.id)
     temp = TransactionTemplate(**data, user_id=current_user.id, order=order)
-    db.session.add(temp)
-    db.session.commit()
     for record in records:
-        db.session.add(
-            RecordTemplate(**record, template_id=temp.id)
-        )
+        RecordTemplate(**record, template=temp)
     for flow in flows:
-        db.session.add(
-            FlowTemplate(**flow, template_id=temp.id)
-        )
+        FlowTemplate(**flow, template=temp)
+    db.session.add(temp)
     db.session.commit()
         
     return '', HTTPStatus.CREATED
@@ -118,12 +116,50 @@ def delete_template(template_id: int):
     if temp is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     
-    for record in temp.records:
-        db.session.delete(record)
-    for flow in temp.flows:
-        db.session.delete(flow)
-
+    for model in [RecordTemplate, FlowTemplate]:
+        db.session.execute(sqlalchemy.delete(model.__table__).where(model.template_id == temp.id))
+    DataVersion.bump(current_user.id, ['record_template', 'flow_template'])
     db.session.delete(temp)
     db.session.commit()
 
-    return jsonify({}), HTTPStatus.OK
\ No newline at end of file
+    return jsonify({}), HTTPStatus.OK
+
+@templates.route("/orders", methods=["PUT"])
+@login_required
+@validate({
+    "type": "object",
+    "properties": {
+        "orders": {
+            "type": "array",
+            "items": {"type": "integer"}
+        },
+        "ids": {
+            "type": "array",
+            "items": {"type": "integer"}
+        },
+    },
+    "required": ["orders", "ids"]
+})
+def edit_template_orders(orders: list[int], ids: list[int]):
+    reorder(TransactionTemplate, [TransactionTemplate.user_id == current_user.id], ids, orders)
+    db.session.commit()
+    return '', HTTPStatus.CREATED
+
+@templates.route("/orders/move", methods=["PUT"])
+@login_required
+@validate({
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "before": {"type": "integer"},
+        "after": {"type": "integer"}
+    },
+    "required": ["id"]
+})
+def move_template(id: int, before: int = None, after: int = None):
+    temp = TransactionTemplate.query.filter_by(user_id=current_user.id, id=id).first()
+    if temp is None:
+        raise APIError(HTTPStatus.BAD_REQUEST, "non-existent template id")
+    move(temp, [TransactionTemplate.user_id == current_user.id], before=before, after=after)
+    db.session.commit()
+    return '', HTTPStatus.CREATED
\ No newline at end of file
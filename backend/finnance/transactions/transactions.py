@@ -1,14 +1,21 @@
+import csv
+import io
+import json
+from collections import defaultdict
 from datetime import datetime
 from http import HTTPStatus
-from math import ceil
 
-from finnance.agents import create_agent_ifnx
+import sqlalchemy
+from finnance.agents import resolve_agents
 from finnance.errors import APIError, validate
-from finnance.models import (Account, Category, Currency, Flow, Record,
-                             Transaction, JSONModel)
-from finnance.params import parseSearchParams, ModelID
-from flask import Blueprint, jsonify, request
+from finnance.models import (Account, AccountBalance, Agent, Category, Currency, DataVersion,
+                             Flow, MonthlyTotal, Record, Transaction, JSONModel)
+from finnance.params import Cursor, ModelID, paginate, parseSearchParams
+from finnance.search import index_rows, matches
+from flask import Blueprint, request
 from flask_login import current_user, login_required
+from jsonschema import Draft202012Validator
+from jsonschema.exceptions import best_match
 
 from finnance import db
 
@@ -17,7 +24,8 @@ transactions = Blueprint('transactions', __name__, url_prefix='/api/transactions
 @transactions.route("/<int:transaction_id>")
 @login_required
 def transaction(transaction_id: int):
-    trans = Transaction.query.filter_by(id=transaction_id, user_id=current_user.id).first()
+    trans = Transaction.query.options(*Transaction.json_options()).filter_by(
+        id=transaction_id, user_id=current_user.id).first()
     if trans is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     return trans.api()
@@ -26,40 +34,43 @@ def transaction(transaction_id: int):
 @login_required
 def get_transactions():
     kwargs = parseSearchParams(request.args.to_dict(), dict(
-        start=datetime, end=datetime, account_id=ModelID, search=str
+        start=datetime, end=datetime, account_id=ModelID, search=str, before=Cursor
     ))
 
-    result = Transaction.query.filter_by(user_id=current_user.id).order_by(Transaction.date_issued.desc())
+    result = Transaction.query.options(*Transaction.json_options()).filter_by(user_id=current_user.id)
     if 'start' in kwargs:
         result = result.filter(Transaction.date_issued >= kwargs.get('start'))
     if 'end' in kwargs:
         result = result.filter(Transaction.date_issued < kwargs.get('end'))
     if 'account_id' in kwargs:
         result = result.filter_by(account_id=kwargs['account_id'].id)
-    
-    pagesize = kwargs.get('pagesize')
-    page = kwargs.get('page')
-
-    # search filter
-    result = list(filter(
-        lambda t: 'search' not in kwargs or any(
-            kwargs['search'].lower() in string for string in [
-                t.comment.lower(),
-                t.agent.desc.lower(),
-                t.account.desc.lower() if t.account_id is not None else t.flows[0].agent_desc
-        ]),
-        result.all()
-    ))
+
+    # search filter
+    if 'search' in kwargs:
+        search = kwargs['search']
+        # remote transactions show their remote agent instead of an account
+        remote = Flow.query.join(Agent).filter(
+            Flow.trans_id == Transaction.id, matches(search, ('agent', Flow.agent_id, Agent.desc))
+        ).exists()
+        result = result.join(Agent).join(Account, isouter=True).filter(sqlalchemy.or_(
+            matches(search,
+                ('trans', Transaction.id, Transaction.comment),
+                ('agent', Transaction.agent_id, Agent.desc),
+                ('account', Transaction.account_id, Account.desc)),
+            sqlalchemy.and_(Transaction.account_id.is_(None), remote)
+        ))
+
+    pages, result = paginate(result, Transaction.date_issued, Transaction.id,
+                             kwargs.get('pagesize'), kwargs.get('page'), kwargs.get('before'))
     return JSONModel.obj_to_api(dict(
-        pages= ceil(len(result) / pagesize),
+        pages=pages,
+        next=Cursor.of(result[-1].date_issued, result[-1].id) if len(result) else None,
         transactions=[
         trans.json(deep=True)
-        for trans in result[pagesize*page:pagesize*(page+1)]
+        for trans in result
     ]))
 
-@transactions.route("/add", methods=["POST"])
-@login_required
-@validate({
+transaction_schema = {
     "type": "object",
     "properties": {
         "account_id": {"type": "integer"},
@@ -95,7 +106,19 @@ def get_transactions():
         },
     },
     "required": ["currency_id", "amount", "date_issued", "is_expense", "agent", "comment", "direct", "flows", "records"]
-})
+}
+
+def trans_flows(data: dict) -> list[dict]:
+    # flows of a new transaction, implied by remote_agent and direct
+    if len(data.get('remote_agent', '')):
+        return [dict(agent=data['remote_agent'], is_debt=data['is_expense'], amount=data['amount'])]
+    if data['direct']:
+        return [dict(agent=data['agent'], is_debt=not data['is_expense'], amount=data['amount'])]
+    return [dict(flow, is_debt=not data['is_expense']) for flow in data['flows']]
+
+@transactions.route("/add", methods=["POST"])
+@login_required
+@validate(transaction_schema)
 def add_trans(**data):
     data['date_issued'] = datetime.fromisoformat(data.pop('date_issued'))
 
@@ -108,7 +131,7 @@ def add_trans(**data):
         data['currency_id'] = account.currency_id
 
     else: # 'currency_id' in data:
-        currency = Currency.query.filter_by(id=data['currency_id'], user_id=current_user.id)
+        currency = Currency.query.filter_by(id=data['currency_id'], user_id=current_user.id).first()
         if currency is None:
             raise APIError(HTTPStatus.BAD_REQUEST, 'invalid currency_id')
     
@@ -118,48 +141,172 @@ def add_trans(**data):
         if cat is None:
             raise APIError(HTTPStatus.BAD_REQUEST, 'invalid category_id')
     # AGENTs
-    agent = create_agent_ifnx(data.pop('agent'))
-    data['agent_id'] = agent.id
-    
-    if 'remote_agent' in data and len(data['remote_agent']):
-        flows = [{
-            'agent': data['remote_agent'],
-            'is_debt': data['is_expense'],
-            'amount': data['amount']
-        }]
-    elif data['direct']:
-        flows = [{
-            'agent': agent.desc,
-            'is_debt': not data['is_expense'],
-            'amount': data['amount']
-        }]
-    else:
-        flows = data['flows']
-        for flow in flows:
-            flow['is_debt'] = not data['is_expense']
+    flows = trans_flows(data)
+    agents = resolve_agents([data['agent']] + [flow['agent'] for flow in flows])
+    data['agent_id'] = agents[data.pop('agent')].id
 
     data.pop('direct')
     data.pop('remote_agent', 0) # not necessarily included
     data.pop('flows')
 
-    for flow in flows:
-        flow['agent_id'] = create_agent_ifnx(flow.pop('agent')).id
-
+    # through the relationships, so that one flush writes everything
     trans = Transaction(**data, user_id=current_user.id)
-    db.session.add(trans)
-    db.session.commit()
     for record in records:
-        db.session.add(
-            Record(**record, trans_id=trans.id)
-        )
+        Record(**record, trans=trans)
     for flow in flows:
-        db.session.add(
-            Flow(**flow, trans_id=trans.id)
-        )
+        Flow(agent_id=agents[flow['agent']].id, is_debt=flow['is_debt'], amount=flow['amount'], trans=trans)
+    db.session.add(trans)
+    AccountBalance.book(trans.saldo_changes())
+    Agent.book(trans.agent_uses())
+    MonthlyTotal.book(trans.monthly_totals())
     db.session.commit()
         
     return '', HTTPStatus.CREATED
 
+def csv_transactions(text: str):
+    # one record per line, the columns are the fields of transaction_schema
+    # plus category_id, flows can't be given
+    for line in csv.DictReader(io.StringIO(text)):
+        data = {key: value for key, value in line.items() if value not in [None, '']}
+        try:
+            for key in ['account_id', 'currency_id', 'amount', 'category_id']:
+                if key in data:
+                    data[key] = int(data[key])
+            for key in ['is_expense', 'direct']:
+                if data.get(key, 'false').lower() not in ['true', 'false']:
+                    raise ValueError(f"{key} must be either 'true' or 'false'")
+                data[key] = data.get(key, 'false').lower() == 'true'
+        except ValueError as err:
+            yield None, str(err)
+            continue
+        data.setdefault('comment', '')
+        data['flows'] = []
+        data['records'] = [
+            dict(category_id=data.pop('category_id'), amount=data.get('amount'))
+        ] if 'category_id' in data else []
+        yield data, None
+
+@transactions.route("/bulk", methods=["POST"])
+@login_required
+def bulk_add_trans():
+    if request.mimetype == 'text/csv':
+        parsed = list(csv_transactions(request.data.decode()))
+    else:
+        try:
+            items = json.loads(request.data.decode())
+        except json.decoder.JSONDecodeError:
+            raise APIError(HTTPStatus.BAD_REQUEST, "Non-JSON format")
+        if not isinstance(items, list):
+            raise APIError(HTTPStatus.BAD_REQUEST, "expected an array of transactions")
+        parsed = [(data, None) for data in items]
+
+    validator = Draft202012Validator(schema=transaction_schema)
+    rows = []
+    for data, error in parsed:
+        if error is None and (invalid := best_match(validator.iter_errors(data))) is not None:
+            data, error = None, f"Invalid JSON schema: {invalid.message}"
+        rows.append((data, error))
+
+    # everything referenced by any row in one query per table
+    valid = [data for data, _ in rows if data is not None]
+    accounts = dict(db.session.query(Account.id, Account.currency_id).filter(
+        Account.user_id == current_user.id,
+        Account.id.in_({data['account_id'] for data in valid if 'account_id' in data})))
+    currencies = set(db.session.scalars(sqlalchemy.select(Currency.id).where(
+        Currency.user_id == current_user.id,
+        Currency.id.in_({data['currency_id'] for data in valid}))))
+    categories = set(db.session.scalars(sqlalchemy.select(Category.id).where(
+        Category.user_id == current_user.id,
+        Category.id.in_({rec['category_id'] for data in valid for rec in data.get('records', [])}))))
+
+    errors = []
+    for row, (data, error) in enumerate(rows):
+        if error is None:
+            error = check_bulk_row(data, accounts, currencies, categories)
+        if error is not None:
+            errors.append(dict(row=row, error=error))
+    if len(errors) > 0:
+        return JSONModel.obj_to_api(dict(errors=errors)), HTTPStatus.BAD_REQUEST
+
+    flows = [trans_flows(data) for data in valid]
+    agents = resolve_agents([data['agent'] for data in valid] + [
+        flow['agent'] for implied in flows for flow in implied])
+    # descs that differ but resolve to the same agent under the collation
+    errors = [
+        dict(row=row, error='flows: duplicate agent')
+        for row, implied in enumerate(flows)
+        if len({agents[flow['agent']].id for flow in implied}) != len(implied)
+    ]
+    if len(errors) > 0:
+        return JSONModel.obj_to_api(dict(errors=errors)), HTTPStatus.BAD_REQUEST
+
+    # bulk inserts around the orm, so everything the flush hooks and the
+    # endpoints keep up to date is done here
+    trans_rows = [
+        dict(account_id=data.get('account_id'), currency_id=data['currency_id'], amount=data['amount'],
+             date_issued=data['date_issued'], is_expense=data['is_expense'],
+             agent_id=agents[data['agent']].id, comment=data['comment'], user_id=current_user.id)
+        for data in valid
+    ]
+    # chunked, ordered returning falls back to small batches on sqlite
+    # that get spliced together at a cost growing with the statement
+    ids = [
+        id for i in range(0, len(trans_rows), 1000) for id in db.session.scalars(
+            sqlalchemy.insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True),
+            trans_rows[i:i + 1000])
+    ]
+    records = [dict(record, trans_id=id) for id, data in zip(ids, valid) for record in data['records']]
+    if len(records) > 0:
+        db.session.execute(sqlalchemy.insert(Record), records)
+    new_flows = [
+        dict(amount=flow['amount'], is_debt=flow['is_debt'], agent_id=agents[flow['agent']].id, trans_id=id)
+        for id, implied in zip(ids, flows) for flow in implied
+    ]
+    if len(new_flows) > 0:
+        db.session.execute(sqlalchemy.insert(Flow), new_flows)
+
+    balances = defaultdict(int)
+    for data in valid:
+        if 'account_id' in data:
+            balances[data['account_id']] += -data['amount'] if data['is_expense'] else data['amount']
+    AccountBalance.book(list(balances.items()))
+    Agent.book([(row['agent_id'], 1) for row in trans_rows] + [(flow['agent_id'], 1) for flow in new_flows])
+    MonthlyTotal.book([
+        ((current_user.id, data['currency_id'], data['date_issued'].strftime('%Y-%m'),
+          record['category_id'], agents[data['agent']].id, data['is_expense']), record['amount'])
+        for data in valid for record in data['records']
+    ])
+    index_rows('trans', [(id, data['comment'], current_user.id) for id, data in zip(ids, valid)])
+    DataVersion.bump(current_user.id, ['trans', 'record', 'flow', 'agent'])
+    db.session.commit()
+
+    return JSONModel.obj_to_api(dict(created=len(ids))), HTTPStatus.CREATED
+
+def check_bulk_row(data: dict, accounts: dict, currencies: set, categories: set):
+    # the checks of add_trans against the prefetched ids, None if fine
+    try:
+        data['date_issued'] = datetime.fromisoformat(data['date_issued'])
+    except ValueError:
+        return 'date_issued: invalid iso format'
+    if 'account_id' in data:
+        if data['account_id'] not in accounts:
+            return 'invalid account_id'
+        if accounts[data['account_id']] != data['currency_id']:
+            return 'account and currency don\'t match'
+    elif data['currency_id'] not in currencies:
+        return 'invalid currency_id'
+    for record in data['records']:
+        if record['category_id'] not in categories:
+            return 'invalid category_id'
+    # one record per category and one flow per agent, unique in the tables
+    category_ids = [record['category_id'] for record in data['records']]
+    if len(set(category_ids)) != len(category_ids):
+        return 'records: duplicate category_id'
+    flow_agents = [flow['agent'] for flow in trans_flows(data)]
+    if len(set(flow_agents)) != len(flow_agents):
+        return 'flows: duplicate agent'
+    return None
+
 @transactions.route("/<int:transaction_id>/edit", methods=["PUT"])
 @login_required
 @validate({
@@ -202,6 +349,9 @@ def edit_transaction(transaction_id: int, **data):
     trans = Transaction.query.filter_by(user_id=current_user.id, id=transaction_id).first()
     if trans is None:
         raise APIError(HTTPStatus.NOT_FOUND)
+    saldo_changes = trans.saldo_changes()
+    monthly_totals = trans.monthly_totals()
+    agent_uses = trans.agent_uses()
 
     if 'date_issued' in data:
         issued = datetime.fromisoformat(data.pop('date_issued'))
@@ -225,24 +375,6 @@ def edit_transaction(transaction_id: int, **data):
         
         trans.currency_id = currency.id
 
-    agent = None
-    if 'agent' in data and data['agent'] != trans.agent.desc:
-        agent = create_agent_ifnx(data.pop('agent'))
-        db.session.commit()
-        trans.agent_id = agent.id
-    
-    if 'comment' in data and data['comment'] != trans.comment:
-        trans.comment = data['comment']
-    
-    is_expense = trans.is_expense
-    if 'is_expense' in data and data['is_expense'] != trans.is_expense:
-
-        is_expense = data['is_expense']
-        trans.is_expense = is_expense
-    
-    if 'amount' in data and data['amount'] != trans.amount:
-        trans.amount = data['amount']
-    
     flows = None
     if 'remote_agent' in data and len(data['remote_agent']):
         flows = [{
@@ -252,7 +384,7 @@ def edit_transaction(transaction_id: int, **data):
         }]
     elif 'direct' in data and data['direct']:
         flows = [{
-            'agent': agent.desc if agent is not None else trans.agent.desc,
+            'agent': data.get('agent', trans.agent.desc),
             'is_debt': not data['is_expense'],
             'amount': data['amount']
         }]
@@ -261,14 +393,29 @@ def edit_transaction(transaction_id: int, **data):
         for flow in flows:
             flow['is_debt'] = not data['is_expense']
 
+    agents = resolve_agents([data.get('agent')] + [flow['agent'] for flow in flows or []])
+    if 'agent' in data and data['agent'] != trans.agent.desc:
+        trans.agent_id = agents[data.pop('agent')].id
+    
+    if 'comment' in data and data['comment'] != trans.comment:
+        trans.comment = data['comment']
+    
+    is_expense = trans.is_expense
+    if 'is_expense' in data and data['is_expense'] != trans.is_expense:
+
+        is_expense = data['is_expense']
+        trans.is_expense = is_expense
+    
+    if 'amount' in data and data['amount'] != trans.amount:
+        trans.amount = data['amount']
+    
     data.pop('direct', 0)
     data.pop('remote_agent', 0)
     data.pop('flows', 0)
     
     if flows is not None:
         for flow_data, flow in zip(flows, trans.flows):
-            agent = create_agent_ifnx(flow_data['agent'])
-            flow.agent_id = agent.id
+            flow.agent_id = agents[flow_data['agent']].id
             flow.is_debt = flow_data['is_debt']
             flow.amount = flow_data['amount']
 
@@ -277,7 +424,7 @@ def edit_transaction(transaction_id: int, **data):
         
         for flow_data in flows[len(trans.flows):]:
             flow = Flow(
-                agent_id = create_agent_ifnx(flow_data.pop('agent')).id,
+                agent_id = agents[flow_data.pop('agent')].id,
                 is_debt = flow_data['is_debt'],
                 amount = flow_data['amount'],
                 trans_id = transaction_id
@@ -310,6 +457,13 @@ def edit_transaction(transaction_id: int, **data):
             )
             db.session.add(rec)
 
+    AccountBalance.book(saldo_changes, sign=-1)
+    AccountBalance.book(trans.saldo_changes())
+    db.session.flush()
+    db.session.expire(trans, ['records', 'flows'])
+    MonthlyTotal.book(monthly_totals, sign=-1)
+    MonthlyTotal.book(trans.monthly_totals())
+    Agent.book([(agent_id, -uses) for agent_id, uses in agent_uses] + trans.agent_uses())
     db.session.commit()
         
     return '', HTTPStatus.CREATED
@@ -321,11 +475,7 @@ def delete_transaction(transaction_id: int):
     if trans is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     
-    for flow in trans.flows:
-        db.session.delete(flow)
-    for rec in trans.records:
-        db.session.delete(rec)
-    db.session.delete(trans)
+    Transaction.delete_where(Transaction.id == trans.id)
     db.session.commit()
 
     return '', HTTPStatus.OK
\ No newline at end of file
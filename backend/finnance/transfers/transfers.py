@@ -2,8 +2,8 @@ from datetime import datetime
 from http import HTTPStatus
 
 from finnance.errors import APIError, validate
-from finnance.models import Account, AccountTransfer, Currency
-from flask import Blueprint, jsonify
+from finnance.models import Account, AccountBalance, AccountTransfer
+from flask import Blueprint
 from flask_login import current_user, login_required
 
 from finnance import db
@@ -13,7 +13,8 @@ transfers = Blueprint('transfers', __name__, url_prefix='/api/transfers')
 @transfers.route("/<int:transfer_id>")
 @login_required
 def transfer(transfer_id: int):
-    transfer = AccountTransfer.filter_by(user_id=current_user.id, id=transfer_id).first()
+    transfer = AccountTransfer.query.options(*AccountTransfer.json_options()).filter_by(
+        user_id=current_user.id, id=transfer_id).first()
     if transfer is None:
         raise APIError(HTTPStatus.NOT_FOUND)
 
@@ -53,6 +54,7 @@ def add_transfer(src_id: int, dst_id: int, src_amount: int, dst_amount: int, dat
     transfer = AccountTransfer(src_id=src_id, dst_id=dst_id, src_amount=src_amount, dst_amount=dst_amount,
         date_issued=date_issued, comment=comment, user_id=current_user.id)
     db.session.add(transfer)
+    AccountBalance.book(transfer.saldo_changes())
     db.session.commit()
     return '', HTTPStatus.CREATED
 
@@ -73,7 +75,7 @@ def edit_transfer(transfer_id: int, **data):
     transfer = AccountTransfer.query.filter_by(user_id=current_user.id, id=transfer_id).first()
     if transfer is None:
         raise APIError(HTTPStatus.NOT_FOUND)
-
+    saldo_changes = transfer.saldo_changes()
 
     source = transfer.src
     if 'src_id' in data:
@@ -109,6 +111,8 @@ def edit_transfer(transfer_id: int, **data):
     if 'comment' in data:
         transfer.comment = data['comment']
 
+    AccountBalance.book(saldo_changes, sign=-1)
+    AccountBalance.book(transfer.saldo_changes())
     db.session.commit()
     return '', HTTPStatus.CREATED
 
@@ -119,6 +123,7 @@ def delete_transfer(transfer_id: int):
     if tf is None:
         raise APIError(HTTPStatus.NOT_FOUND)
     
+    AccountBalance.book(tf.saldo_changes(), sign=-1)
     db.session.delete(tf)
     db.session.commit()
 
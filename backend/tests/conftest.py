@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from finnance import create_app, db
+
+
+class Config:
+    TESTING = True
+    SECRET_KEY = 'test'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # every request is built from the database, nothing cached
+    NIVO_CACHE_BYTES = 0
+    AGENT_INDEX_USERS = 8
+
+
+@pytest.fixture
+def app():
+    app = create_app(Config)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    for url, data in [
+        ('/api/auth/register', dict(username='finn', email='finn@example.com', password='secret')),
+        ('/api/auth/login', dict(username='finn', password='secret')),
+        ('/api/currencies/add', dict(code='CHF', decimals=2)),
+    ]:
+        assert client.post(url, data=json.dumps(data)).status_code < 300
+    return client
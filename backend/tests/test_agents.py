@@ -0,0 +1,27 @@
+import json
+
+from finnance import db
+from finnance.models import Agent, Flow
+
+
+def test_resolve_more_agents_than_sqlite_allows_per_union(app, client):
+    # one lookup per 400 descs, a single union of them fails above 500
+    descs = [f'agent {i}' for i in range(600)]
+    response = client.post('/api/transactions/add', data=json.dumps(dict(
+        currency_id=1, amount=600, date_issued='2023-05-01T12:00:00', is_expense=True,
+        agent=descs[0], comment='many', direct=False, records=[],
+        flows=[dict(amount=1, agent=desc) for desc in descs])))
+    assert response.status_code == 201, response.data
+
+    with app.app_context():
+        assert {desc for desc, in db.session.query(Agent.desc)} == set(descs)
+        assert db.session.query(Flow).count() == 600
+
+    # and once more, now that all of them exist
+    response = client.post('/api/transactions/add', data=json.dumps(dict(
+        currency_id=1, amount=600, date_issued='2023-05-02T12:00:00', is_expense=True,
+        agent=descs[-1], comment='again', direct=False, records=[],
+        flows=[dict(amount=1, agent=desc) for desc in descs])))
+    assert response.status_code == 201, response.data
+    with app.app_context():
+        assert db.session.query(Agent).count() == 600
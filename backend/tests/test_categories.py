@@ -0,0 +1,33 @@
+import json
+
+
+def add_category(client, desc: str):
+    response = client.post('/api/categories/add', data=json.dumps(dict(
+        desc=desc, is_expense=True, color='#123456', usable=True, parent_id=None)))
+    assert response.status_code == 201
+
+
+def test_descs_etag(client):
+    add_category(client, 'Food')
+    response = client.get('/api/categories/expenses')
+    assert response.status_code == 200
+    tag, _ = response.get_etag()
+    assert tag is not None
+    assert response.cache_control.private and response.cache_control.no_cache
+
+    response = client.get('/api/categories/expenses', headers={'If-None-Match': f'"{tag}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.get_etag() == (tag, False)
+
+    # other tables don't change the tag, a new category does
+    response = client.post('/api/currencies/add', data=json.dumps(dict(code='EUR', decimals=2)))
+    assert response.status_code < 300
+    response = client.get('/api/categories/expenses', headers={'If-None-Match': f'"{tag}"'})
+    assert response.status_code == 304
+
+    add_category(client, 'Drinks')
+    response = client.get('/api/categories/expenses', headers={'If-None-Match': f'"{tag}"'})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != tag
+    assert 'Drinks' in json.dumps(response.json)
@@ -0,0 +1,109 @@
+import json
+
+import sqlalchemy
+
+from finnance import db
+from finnance.categories.categories import rebuild_closure
+from finnance.migrations import SchemaMigration
+from finnance.models import Account, AccountBalance, Agent, CategoryClosure, DataVersion, MonthlyTotal
+from finnance.nivo.nivo import rebuild_monthly_totals
+from finnance.search import SearchTrigram, rebuild
+
+
+def send(client, method: str, url: str, **data):
+    response = client.open(url, method=method, data=json.dumps(data))
+    assert response.status_code in [200, 201], response.data
+
+
+def rows(model) -> list[tuple]:
+    return sorted(tuple(row) for row in db.session.execute(sqlalchemy.select(model.__table__)))
+
+
+def transaction(**data):
+    return dict(dict(
+        account_id=1, currency_id=1, amount=300, date_issued='2023-05-01T12:00:00', is_expense=True,
+        agent='Migros', comment='Groceries', direct=False, flows=[],
+        records=[dict(category_id=1, amount=200), dict(category_id=3, amount=100)]), **data)
+
+
+def assert_derived_state(app):
+    with app.app_context():
+        for account_id, in db.session.query(Account.id):
+            assert db.session.get(AccountBalance, account_id).delta == AccountBalance.compute(account_id)
+        assert [(id, uses) for id, uses, _ in db.session.query(Agent.id, Agent.uses, Agent.count_uses())] \
+            == [(id, count) for id, _, count in db.session.query(Agent.id, Agent.uses, Agent.count_uses())]
+
+        for model, rebuild_table in [(MonthlyTotal, rebuild_monthly_totals),
+                                     (CategoryClosure, rebuild_closure), (SearchTrigram, rebuild)]:
+            booked = rows(model)
+            rebuild_table()
+            assert booked == rows(model), model.__name__
+
+
+def add_history(client):
+    send(client, 'POST', '/api/accounts/add', desc='Bank', color='#123456',
+         date_created='2023-01-01T00:00:00', starting_saldo=1000, currency_id=1)
+    send(client, 'POST', '/api/accounts/add', desc='Wallet', color='#654321',
+         date_created='2023-01-01T00:00:00', starting_saldo=50, currency_id=1)
+    for desc, parent_id in [('Food', None), ('Drinks', None), ('Restaurants', 1), ('Bars', 2)]:
+        send(client, 'POST', '/api/categories/add', desc=desc, is_expense=True, color='#123456',
+             usable=True, parent_id=parent_id)
+
+    send(client, 'POST', '/api/transactions/add', **transaction())
+    send(client, 'POST', '/api/transactions/add', **transaction(
+        account_id=2, amount=80, agent='Coop', comment='Café', date_issued='2023-06-03T12:00:00',
+        flows=[dict(agent='Anna', amount=40)], records=[dict(category_id=4, amount=40)]))
+    send(client, 'POST', '/api/transactions/add', **transaction(
+        amount=50, agent='Anna', comment='paid back', is_expense=False, date_issued='2023-06-04T12:00:00',
+        records=[], flows=[dict(agent='Anna', amount=50)]))
+    send(client, 'POST', '/api/transfers/add', src_id=1, dst_id=2, src_amount=100, dst_amount=100,
+         date_issued='2023-05-02T12:00:00', comment='cash')
+
+
+def test_derived_tables_match_rebuilds(app, client):
+    add_history(client)
+    assert_derived_state(app)
+
+    # moves between months, agents, accounts and categories
+    send(client, 'PUT', '/api/transactions/1/edit', **transaction(
+        account_id=2, agent='Coop', comment='Dinner', date_issued='2023-07-01T12:00:00',
+        records=[dict(category_id=4, amount=300)]))
+    send(client, 'PUT', '/api/transfers/1/edit', src_amount=120, dst_amount=110)
+    send(client, 'PUT', '/api/categories/3/edit', parent_id=2)
+    send(client, 'PUT', '/api/categories/2/edit', parent_id=1)
+    assert_derived_state(app)
+
+    send(client, 'DELETE', '/api/transactions/2/delete')
+    send(client, 'DELETE', '/api/transfers/1/delete')
+    assert_derived_state(app)
+
+
+def test_migrate_baseline_database(app, client):
+    add_history(client)
+    # back to the schema from before the derived tables and indexes
+    with app.app_context():
+        for model in [SchemaMigration, SearchTrigram, MonthlyTotal, CategoryClosure, AccountBalance, DataVersion]:
+            model.__table__.drop(db.engine)
+        inspector = sqlalchemy.inspect(db.engine)
+        for table in inspector.get_table_names():
+            for index in inspector.get_indexes(table):
+                if index['name'].startswith('ix_'):
+                    db.session.execute(sqlalchemy.text(f'DROP INDEX {index["name"]}'))
+        db.session.execute(sqlalchemy.text('ALTER TABLE agent DROP COLUMN uses'))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0, result.output
+    assert 'migration 7: account balances' in result.output
+
+    with app.app_context():
+        inspector = sqlalchemy.inspect(db.engine)
+        assert 'uses' in [column['name'] for column in inspector.get_columns('agent')]
+        for table in db.metadata.sorted_tables:
+            assert {index.name for index in table.indexes} \
+                <= {index['name'] for index in inspector.get_indexes(table.name)}, table.name
+    assert_derived_state(app)
+
+    # and nothing left to do the second time
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.output == 'schema up to date\n'
@@ -0,0 +1,57 @@
+import json
+
+import sqlalchemy
+
+from finnance import db
+
+
+def add_categories(client, first: int, last: int):
+    # roots with two levels of children below them
+    for i in range(first, last):
+        parent = None if i % 5 == 0 else i - (i % 5 > 2)
+        response = client.post('/api/categories/add', data=json.dumps(dict(
+            desc=f'category {i}', is_expense=True, color='#123456', usable=True, parent_id=parent)))
+        assert response.status_code == 201
+
+
+def add_transactions(client, category_ids: list[int]):
+    for agent in ['Migros', 'Coop', 'SBB']:
+        response = client.post('/api/transactions/add', data=json.dumps(dict(
+            currency_id=1, amount=100 * len(category_ids), date_issued='2023-05-01T12:00:00',
+            is_expense=True, agent=agent, comment=agent, direct=False, remote_agent='Bank', flows=[],
+            records=[dict(category_id=id, amount=100) for id in category_ids])))
+        assert response.status_code == 201
+
+
+def sunburst_queries(app, client) -> tuple[int, dict]:
+    statements = []
+    def count(*args):
+        statements.append(args[2])
+    with app.app_context():
+        engine = db.engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.get('/api/nivo/sunburst', query_string=dict(
+            currency_id=1, is_expense='true', min_date='2023-01-01', max_date='2024-01-01'))
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(statements), response.json
+
+
+def total(node) -> int:
+    if 'children' not in node:
+        return node['value']
+    return sum(total(child) for child in node['children'])
+
+
+def test_sunburst_queries_constant(app, client):
+    queries = {}
+    for first, last in [(0, 5), (5, 20), (20, 60)]:
+        add_categories(client, first, last)
+        # ids start at 1, every category gets a record of 100 per agent
+        add_transactions(client, list(range(first + 1, last + 1)))
+        queries[last], data = sunburst_queries(app, client)
+        assert total(data) == 3 * 100 * last
+
+    assert queries[5] == queries[20] == queries[60], queries
@@ -0,0 +1,84 @@
+import json
+
+from finnance import db
+from finnance.models import Agent, Flow, Record, Transaction
+
+
+def add_category(client, desc='Food'):
+    response = client.post('/api/categories/add', data=json.dumps(dict(
+        desc=desc, is_expense=True, color='#123456', usable=True, parent_id=None)))
+    assert response.status_code == 201
+
+
+def bulk_row(i: int, **data):
+    return dict(dict(
+        currency_id=1, amount=100 + i, date_issued=f'2023-{i % 12 + 1:02d}-01T12:00:00', is_expense=True,
+        agent=f'counterparty {i}', comment=f'row {i}', direct=False, flows=[],
+        records=[dict(category_id=1, amount=100 + i)]), **data)
+
+
+def test_bulk_import_many_agents(app, client):
+    # bank exports have far more counterparties than fit in one lookup
+    add_category(client)
+    rows = [bulk_row(i) for i in range(1500)]
+    rows[0] = bulk_row(0, flows=[dict(agent=f'friend {i}', amount=1) for i in range(3)])
+    response = client.post('/api/transactions/bulk', data=json.dumps(rows))
+    assert response.status_code == 201, response.data
+    assert response.json == dict(created=1500)
+
+    with app.app_context():
+        assert db.session.query(Transaction).count() == 1500
+        assert db.session.query(Record).count() == 1500
+        assert db.session.query(Flow).count() == 3
+        assert db.session.query(Agent).count() == 1503
+
+
+def test_bulk_import_rejects_duplicates_per_row(app, client):
+    add_category(client)
+    add_category(client, 'Drinks')
+    rows = [
+        bulk_row(0),
+        bulk_row(1, records=[dict(category_id=1, amount=50), dict(category_id=1, amount=51)]),
+        bulk_row(2, flows=[dict(agent='Anna', amount=1), dict(agent='Anna', amount=2)]),
+        bulk_row(3, records=[dict(category_id=1, amount=50), dict(category_id=2, amount=53)]),
+    ]
+    response = client.post('/api/transactions/bulk', data=json.dumps(rows))
+    assert response.status_code == 400
+    assert response.json == dict(errors=[
+        dict(row=1, error='records: duplicate category_id'),
+        dict(row=2, error='flows: duplicate agent'),
+    ])
+
+    with app.app_context():
+        assert db.session.query(Transaction).count() == 0
+        assert db.session.query(Agent).count() == 0
+
+
+def test_transactions_cursor_pagination(client):
+    add_category(client)
+    # two share a date, the id breaks the tie
+    dates = ['2023-01-01', '2023-02-01', '2023-02-01', '2023-03-01', '2023-04-01']
+    for i, date in enumerate(dates):
+        response = client.post('/api/transactions/add', data=json.dumps(
+            bulk_row(i, date_issued=f'{date}T12:00:00', agent='Migros')))
+        assert response.status_code == 201, response.data
+
+    ids, cursor = [], ''
+    while True:
+        response = client.get('/api/transactions', query_string=dict(pagesize=2, before=cursor))
+        assert response.status_code == 200
+        assert response.json['pages'] == 3
+        if len(response.json['transactions']) == 0:
+            assert response.json['next'] is None
+            break
+        ids += [trans['id'] for trans in response.json['transactions']]
+        cursor = response.json['next']
+    assert ids == [5, 4, 3, 2, 1]
+
+    # new rows in front don't shift the pages behind the cursor
+    first = client.get('/api/transactions', query_string=dict(pagesize=2)).json
+    response = client.post('/api/transactions/add', data=json.dumps(
+        bulk_row(5, date_issued='2023-05-01T12:00:00', agent='Migros')))
+    assert response.status_code == 201
+    response = client.get('/api/transactions', query_string=dict(pagesize=2, before=first['next']))
+    assert [trans['id'] for trans in response.json['transactions']] == [3, 2]
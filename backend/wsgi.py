@@ -1 +1,3 @@
-from finnance import app
\ No newline at end of file
+from finnance import create_app
+
+app = create_app()
\ No newline at end of file